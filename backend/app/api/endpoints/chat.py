@@ -1,12 +1,16 @@
 """
 Chat API endpoints
 """
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
-from typing import Dict, Any
+from typing import Any, Dict, Optional, Tuple
+import asyncio
 import uuid
 from datetime import datetime
-from app.db.session import get_db
+import numpy as np
+import orjson
+from app.db.session import SessionLocal, get_db
 from app.core.config import settings
 from app.schemas.chat import (
     ChatQueryRequest,
@@ -16,52 +20,113 @@ from app.schemas.chat import (
     ChatMessage
 )
 from app.services.query_engine import QueryEngine
-from app.services.rag_engine import RAGEngine
+from app.services.rag_engine import RAGEngine, get_rag_engine
+from app.services.conversation_store import ConversationStore
 
 router = APIRouter()
 
-# In-memory conversation storage (replace with Redis/DB in production)
-conversations: Dict[str, Dict[str, Any]] = {}
+# Conversation history lives in Redis so it survives restarts and is shared across workers
+conversation_store = ConversationStore()
+HISTORY_WINDOW = settings.CONVERSATION_HISTORY_WINDOW
+
+
+async def refresh_conversation_summary(conversation_id: str, rag_engine: RAGEngine):
+    """
+    Background task: once HISTORY_WINDOW messages beyond the prompt window are not
+    yet summarized, fold them into the rolling summary (keeps the LLM call off the
+    request path; one call every HISTORY_WINDOW messages). Until then the prompt
+    carries them raw (get_prompt_history), so nothing falls in a gap. The write is a
+    compare-and-set on the summarized message count, so overlapping refreshes cannot
+    overwrite each other.
+    """
+    try:
+        state = await conversation_store.get_summary_state(conversation_id)
+        window_start = state["msg_count"] - HISTORY_WINDOW  # absolute index of the oldest raw message in the prompt
+        if window_start - state["covered"] < HISTORY_WINDOW:
+            return
+        first_stored = state["msg_count"] - len(state["messages"])  # older messages were trimmed from the list
+        start = max(state["covered"], first_stored)
+        aged_out = state["messages"][start - first_stored:window_start - first_stored]
+        summary = await rag_engine.summarize_history(state["summary"], aged_out)
+        if not await conversation_store.set_summary(conversation_id, summary, window_start, state["covered"]):
+            print(f"[Chat] summary refresh for {conversation_id} superseded by a concurrent refresh")
+    except Exception as e:
+        print(f"[Chat] summary refresh failed for {conversation_id}: {e}")
+
+
+async def load_history_and_embedding(
+    request: ChatQueryRequest,
+    rag_engine: RAGEngine
+) -> Tuple[Dict[str, Any], Optional[np.ndarray]]:
+    """
+    Fetch conversation history (summary + recent window) while the question is embedded.
+    Metric questions for a fund are answered from SQL, so they are not embedded up front.
+    """
+    if request.fund_id is not None and rag_engine.is_metric_query(request.query):
+        if request.conversation_id:
+            return await conversation_store.get_prompt_history(request.conversation_id, HISTORY_WINDOW), None
+        return {"messages": [], "summary": None}, None
+
+    embed_task = asyncio.create_task(rag_engine.vector_store.embed_query(request.query))
+    if request.conversation_id:
+        return await asyncio.gather(
+            conversation_store.get_prompt_history(request.conversation_id, HISTORY_WINDOW),
+            embed_task
+        )
+    return {"messages": [], "summary": None}, await embed_task
+
+
+async def record_exchange(
+    request: ChatQueryRequest,
+    answer: str,
+    background_tasks: BackgroundTasks,
+    rag_engine: RAGEngine
+):
+    if not request.conversation_id:
+        return
+    await conversation_store.append(
+        request.conversation_id,
+        {"role": "user", "content": request.query, "timestamp": datetime.utcnow()},
+        {"role": "assistant", "content": answer, "timestamp": datetime.utcnow()},
+        fund_id=request.fund_id
+    )
+    background_tasks.add_task(refresh_conversation_summary, request.conversation_id, rag_engine)
 
 
 @router.post("/query", response_model=ChatQueryResponse)
 async def process_chat_query(
     request: ChatQueryRequest,
-    db: Session = Depends(get_db)
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(get_db),
+    rag_engine: RAGEngine = Depends(get_rag_engine)
 ) -> ChatQueryResponse:
     """
     Process a chat query using RAGEngine.
 
     Steps:
+    0. Load conversation history (summary + recent window) while the question is embedded
     1. Retrieve top documents from vector store
     2. Build context string
     3. Optionally perform SQL-based calculation if question matches known metrics
     4. Generate answer using LLM
     """
 
+    # 1️⃣ Fetch conversation history and embed the question concurrently
+    history, query_embedding = await load_history_and_embedding(request, rag_engine)
+
     # 2️⃣ Query RAG engine
-    rag_engine = RAGEngine(db=db)  # Inject DB if needed for metadata filters
     response = await rag_engine.query(
         question=request.query,
         top_k=settings.TOP_K_RESULTS,
-        fund_id=request.fund_id
+        fund_id=request.fund_id,
+        conversation_history=history["messages"],
+        history_summary=history["summary"],
+        query_embedding=query_embedding,
+        db=db
     )
 
     # 3️⃣ Update conversation history
-    if request.conversation_id:
-        if request.conversation_id not in conversations:
-            conversations[request.conversation_id] = {
-                "fund_id": request.fund_id,
-                "messages": [],
-                "created_at": datetime.utcnow(),
-                "updated_at": datetime.utcnow()
-            }
-        # Append messages
-        conversations[request.conversation_id]["messages"].extend([
-            {"role": "user", "content": request.query, "timestamp": datetime.utcnow()},
-            {"role": "assistant", "content": response["answer"], "timestamp": datetime.utcnow()}
-        ])
-        conversations[request.conversation_id]["updated_at"] = datetime.utcnow()
+    await record_exchange(request, response["answer"], background_tasks, rag_engine)
 
     # 4️⃣ Return structured response
     return ChatQueryResponse(
@@ -70,35 +135,63 @@ async def process_chat_query(
     )
 
 
+@router.post("/query/stream")
+async def stream_chat_query(
+    request: ChatQueryRequest,
+    background_tasks: BackgroundTasks,
+    rag_engine: RAGEngine = Depends(get_rag_engine)
+) -> StreamingResponse:
+    """
+    Same pipeline as /query, streamed as Server-Sent Events: a
+    `data: {"sources": [...]}` frame once retrieval is done, `data: {"delta": ...}`
+    frames while the answer is generated, then a final
+    `data: {"done": true, "answer": ..., "sources": [...]}` frame.
+    """
+    history, query_embedding = await load_history_and_embedding(request, rag_engine)
+
+    async def event_stream():
+        # own session: request-scoped dependencies are torn down before the body is streamed
+        with SessionLocal() as db:
+            async for event in rag_engine.stream_query(
+                question=request.query,
+                top_k=settings.TOP_K_RESULTS,
+                fund_id=request.fund_id,
+                conversation_history=history["messages"],
+                history_summary=history["summary"],
+                query_embedding=query_embedding,
+                db=db
+            ):
+                if event.get("done"):
+                    await record_exchange(request, event["answer"], background_tasks, rag_engine)
+                yield b"data: " + orjson.dumps(event) + b"\n\n"
+
+    # background_tasks run after the stream completes
+    return StreamingResponse(event_stream(), media_type="text/event-stream", background=background_tasks)
+
+
 @router.post("/conversations", response_model=Conversation)
 async def create_conversation(request: ConversationCreate):
     """Create a new conversation"""
     conversation_id = str(uuid.uuid4())
     
-    conversations[conversation_id] = {
-        "fund_id": request.fund_id,
-        "messages": [],
-        "created_at": datetime.utcnow(),
-        "updated_at": datetime.utcnow()
-    }
+    conv = await conversation_store.create(conversation_id, request.fund_id)
     
     return Conversation(
         conversation_id=conversation_id,
         fund_id=request.fund_id,
         messages=[],
-        created_at=conversations[conversation_id]["created_at"],
-        updated_at=conversations[conversation_id]["updated_at"]
+        created_at=conv["created_at"],
+        updated_at=conv["updated_at"]
     )
 
 
 @router.get("/conversations/{conversation_id}", response_model=Conversation)
 async def get_conversation(conversation_id: str):
     """Get conversation history"""
-    if conversation_id not in conversations:
+    conv = await conversation_store.get(conversation_id)
+    if conv is None:
         raise HTTPException(status_code=404, detail="Conversation not found")
     
-    conv = conversations[conversation_id]
-    
     return Conversation(
         conversation_id=conversation_id,
         fund_id=conv["fund_id"],
@@ -111,9 +204,7 @@ async def get_conversation(conversation_id: str):
 @router.delete("/conversations/{conversation_id}")
 async def delete_conversation(conversation_id: str):
     """Delete a conversation"""
-    if conversation_id not in conversations:
+    if not await conversation_store.delete(conversation_id):
         raise HTTPException(status_code=404, detail="Conversation not found")
     
-    del conversations[conversation_id]
-    
     return {"message": "Conversation deleted successfully"}
@@ -1,6 +1,13 @@
 """
 Database initialization
+
+Creates the ORM tables, then applies one-off data migrations. Each migration is
+recorded in schema_migrations and runs once per database, from this script
+(docker-compose runs it before starting the API), never on app startup.
 """
+import numpy as np
+import orjson
+from sqlalchemy import text
 from app.db.base import Base
 from app.db.session import engine
 # Import models to ensure they are registered with SQLAlchemy
@@ -8,11 +15,70 @@ from app.models.fund import Fund  # noqa: F401
 from app.models.transaction import CapitalCall, Distribution, Adjustment  # noqa: F401
 from app.models.document import Document  # noqa: F401
 
+# rows re-written per statement by data migrations
+MIGRATION_BATCH_SIZE = 500
+
+
+def normalize_embeddings(conn):
+    """
+    L2-normalize embeddings stored before vectors were normalized on write; the
+    inner-product search ranks unnormalized rows by magnitude. Done in Python so it
+    works on every pgvector version (l2_normalize() needs 0.7).
+    """
+    if conn.execute(text("SELECT to_regclass('document_embeddings')")).scalar() is None:
+        return  # table not created yet: every row it will hold is normalized on insert
+    last_id = 0
+    while True:
+        rows = conn.execute(text("""
+            SELECT id, embedding::text FROM document_embeddings
+            WHERE id > :last_id AND abs(vector_norm(embedding) - 1) > 1e-4
+            ORDER BY id
+            LIMIT :n
+        """), {"last_id": last_id, "n": MIGRATION_BATCH_SIZE}).all()
+        if not rows:
+            return
+        vecs = np.array([orjson.loads(r[1]) for r in rows], dtype=np.float32)
+        vecs /= np.linalg.norm(vecs, axis=1, keepdims=True) + 1e-12
+        conn.execute(
+            text("UPDATE document_embeddings SET embedding = CAST(:embedding AS vector) WHERE id = :id"),
+            [
+                {"id": r[0], "embedding": orjson.dumps(v, option=orjson.OPT_SERIALIZE_NUMPY).decode()}
+                for r, v in zip(rows, vecs)
+            ]
+        )
+        last_id = rows[-1][0]
+
+
+# (name, migration(conn)) in the order they must be applied
+MIGRATIONS = (
+    ("normalize_embeddings", normalize_embeddings),
+)
+
+
+def run_migrations():
+    """Apply pending data migrations, each in its own transaction."""
+    with engine.begin() as conn:
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                name TEXT PRIMARY KEY,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """))
+        applied = set(conn.execute(text("SELECT name FROM schema_migrations")).scalars())
+    for name, migrate in MIGRATIONS:
+        if name in applied:
+            continue
+        with engine.begin() as conn:
+            migrate(conn)
+            conn.execute(text("INSERT INTO schema_migrations (name) VALUES (:name)"), {"name": name})
+        print(f"Migration {name} applied")
+
 
 def init_db():
     """Initialize database tables"""
     Base.metadata.create_all(bind=engine)
     print("Database tables created successfully!")
+    run_migrations()
 
 
 if __name__ == "__main__":
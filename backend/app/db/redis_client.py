@@ -0,0 +1,12 @@
+"""
+Redis client management
+"""
+from functools import lru_cache
+import redis.asyncio as redis
+from app.core.config import settings
+
+
+@lru_cache(maxsize=1)
+def get_redis() -> redis.Redis:
+    """Get the shared async Redis client (connection pool is created lazily)"""
+    return redis.Redis.from_url(settings.REDIS_URL)
@@ -1,13 +1,54 @@
 """
 Database session management
+
+- engine / SessionLocal: sync psycopg2 engine for the ORM (endpoints, metrics, ingestion)
+- async_engine / AsyncSessionLocal: asyncpg engine for the vector store, so pgvector
+  queries overlap on the event loop instead of occupying worker threads
+
+Both pools come out of one per-process DB_CONNECTION_BUDGET: the sync engine takes
+DB_POOL_SIZE + DB_MAX_OVERFLOW, the async engine the remainder (at least one).
 """
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from pgvector.asyncpg import register_vector
 from app.core.config import settings
 
-engine = create_engine(settings.DATABASE_URL, pool_pre_ping=True)
+engine = create_engine(
+    settings.DATABASE_URL,
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_MAX_OVERFLOW,
+    pool_pre_ping=True,
+    pool_recycle=settings.DB_POOL_RECYCLE,
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+ASYNC_POOL_SIZE = max(1, settings.DB_CONNECTION_BUDGET - settings.DB_POOL_SIZE - settings.DB_MAX_OVERFLOW)
+
+async_engine = create_async_engine(
+    make_url(settings.DATABASE_URL).set(drivername="postgresql+asyncpg"),
+    pool_size=ASYNC_POOL_SIZE,
+    max_overflow=0,
+    pool_pre_ping=True,
+    pool_recycle=settings.DB_POOL_RECYCLE,
+)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+
+async def _register_vector(conn):
+    try:
+        await register_vector(conn)
+    except Exception as e:
+        # extension not installed yet; vector columns fall back to text on this connection
+        print(f"[DB] register_vector error: {e}")
+
+
+@event.listens_for(async_engine.sync_engine, "connect")
+def _on_async_connect(dbapi_connection, connection_record):
+    # binary pgvector codec: numpy arrays in and out, no text (de)serialization
+    dbapi_connection.run_async(_register_vector)
+
 
 def get_db():
     """Get database session"""
@@ -1,10 +1,29 @@
 """
 FastAPI main application entry point
 """
+from contextlib import asynccontextmanager
+import asyncio
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from prometheus_client import make_asgi_app
 from app.core.config import settings
 from app.api.endpoints import documents, funds, chat, metrics
+from app.db.session import async_engine
+from app.services.llm_client import close_embedding_client
+from app.services.rag_engine import get_rag_engine
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # build the shared RAG engine (and the vector store schema) before the first request
+    try:
+        await asyncio.to_thread(get_rag_engine)
+    except Exception as e:
+        print(f"[Startup] RAG engine warm-up failed: {e}")
+    yield
+    await close_embedding_client()
+    await async_engine.dispose()
+
 
 app = FastAPI(
     title=settings.PROJECT_NAME,
@@ -12,6 +31,7 @@ app = FastAPI(
     description="Fund Performance Analysis System API",
     docs_url="/docs",
     redoc_url="/redoc",
+    lifespan=lifespan,
 )
 
 # CORS middleware
@@ -29,6 +49,9 @@ app.include_router(funds.router, prefix="/api/funds", tags=["funds"])
 app.include_router(chat.router, prefix="/api/chat", tags=["chat"])
 app.include_router(metrics.router, prefix="/api/metrics", tags=["metrics"])
 
+# Prometheus scrape endpoint (cache hit/miss counters, etc.)
+app.mount("/metrics", make_asgi_app())
+
 
 @app.get("/")
 async def root():
@@ -0,0 +1,95 @@
+"""
+Coalesces concurrent vector searches into batched pgvector queries.
+
+Callers await search(); requests are queued and a background dispatcher drains
+everything already waiting (up to VECTOR_BATCH_MAX_SIZE) into one
+VectorStore.similarity_search_batch call. With the queue empty it dispatches at
+once; it holds a batch open for up to VECTOR_BATCH_WINDOW_MS only while another
+batch is still in flight, i.e. when there is concurrency to coalesce. Each
+caller's future is resolved with its own slice of the batch result.
+"""
+from typing import Any, Dict, List, Optional, Tuple
+import asyncio
+import numpy as np
+from app.core.config import settings
+from app.services.vector_store import VectorStore
+
+# (embedding, k, fund_id, include_embeddings, future)
+_Request = Tuple[np.ndarray, int, Optional[int], bool, asyncio.Future]
+
+
+class BatchingRetriever:
+    def __init__(self, vector_store: VectorStore):
+        self.vector_store = vector_store
+        self.max_batch = settings.VECTOR_BATCH_MAX_SIZE
+        self.window = settings.VECTOR_BATCH_WINDOW_MS / 1000.0
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._inflight = set()
+
+    def _ensure_worker(self):
+        # started lazily: the dispatcher must live on the loop that serves requests
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done() or self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run())
+
+    async def search(
+        self,
+        embedding: np.ndarray,
+        k: int = 5,
+        fund_id: Optional[int] = None,
+        include_embeddings: bool = False
+    ) -> List[Dict[str, Any]]:
+        self._ensure_worker()
+        future = self._loop.create_future()
+        await self._queue.put((embedding, k, fund_id, include_embeddings, future))
+        return await future
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            deadline = self._loop.time() + self.window
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                # idle: a lone request goes out immediately instead of waiting out the window
+                remaining = deadline - self._loop.time()
+                if not self._inflight or remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+                except asyncio.TimeoutError:
+                    break
+            # dispatch concurrently so the next batch starts filling immediately
+            task = self._loop.create_task(self._dispatch(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _dispatch(self, batch: List[_Request]):
+        # one statement for the whole batch: use the largest k and trim per caller
+        k = max(r[1] for r in batch)
+        include = any(r[3] for r in batch)
+        try:
+            results = await self.vector_store.similarity_search_batch(
+                [r[0] for r in batch],
+                k=k,
+                fund_ids=[r[2] for r in batch],
+                include_embeddings=include
+            )
+        except Exception as e:
+            print(f"[BatchingRetriever] dispatch error: {e}")
+            results = [[] for _ in batch]
+
+        for (_, req_k, _, req_include, future), docs in zip(batch, results):
+            if future.done():
+                continue  # caller was cancelled
+            docs = docs[:req_k]
+            if include and not req_include:
+                docs = [{key: v for key, v in d.items() if key != "embedding"} for d in docs]
+            future.set_result(docs)
@@ -0,0 +1,145 @@
+"""
+Conversation storage backed by Redis.
+
+Keys (both refreshed to expire CONVERSATION_TTL seconds after every write):
+- conv:{cid}:meta     hash {fund_id, created_at, updated_at, msg_count}
+- conv:{cid}:msgs     list of JSON-encoded messages, trimmed to the last CONVERSATION_MAX_MESSAGES
+- conv:{cid}:summary  hash {text, covered}: rolling summary of the first `covered` messages
+"""
+from typing import Any, Dict, Optional
+from datetime import datetime
+import orjson
+from app.core.config import settings
+from app.db.redis_client import get_redis
+
+# compare-and-set on the summary: write only if `covered` still equals the value the caller read
+_SET_SUMMARY_LUA = """
+local covered = tonumber(redis.call('HGET', KEYS[1], 'covered') or '0')
+if covered ~= tonumber(ARGV[3]) then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'text', ARGV[1], 'covered', ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return 1
+"""
+
+
+class ConversationStore:
+    def __init__(self, redis=None):
+        self.redis = redis or get_redis()
+        self.ttl = settings.CONVERSATION_TTL
+        self.max_messages = settings.CONVERSATION_MAX_MESSAGES
+        self._set_summary = self.redis.register_script(_SET_SUMMARY_LUA)
+
+    @staticmethod
+    def _meta_key(cid: str) -> str:
+        return f"conv:{cid}:meta"
+
+    @staticmethod
+    def _msgs_key(cid: str) -> str:
+        return f"conv:{cid}:msgs"
+
+    @staticmethod
+    def _summary_key(cid: str) -> str:
+        return f"conv:{cid}:summary"
+
+    async def create(self, cid: str, fund_id: Optional[int] = None) -> Dict[str, Any]:
+        now = datetime.utcnow()
+        meta_key = self._meta_key(cid)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hset(meta_key, mapping={
+            "fund_id": "" if fund_id is None else str(fund_id),
+            "created_at": now.isoformat(),
+            "updated_at": now.isoformat(),
+        })
+        pipe.expire(meta_key, self.ttl)
+        await pipe.execute()
+        return {"fund_id": fund_id, "messages": [], "created_at": now, "updated_at": now}
+
+    async def get(self, cid: str) -> Optional[Dict[str, Any]]:
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hgetall(self._meta_key(cid))
+        pipe.lrange(self._msgs_key(cid), 0, -1)
+        meta, raw_msgs = await pipe.execute()
+        if not meta:
+            return None
+        fund_id = meta.get(b"fund_id", b"").decode()
+        return {
+            "fund_id": int(fund_id) if fund_id else None,
+            "messages": [orjson.loads(m) for m in raw_msgs],
+            "created_at": datetime.fromisoformat(meta[b"created_at"].decode()),
+            "updated_at": datetime.fromisoformat(meta[b"updated_at"].decode()),
+        }
+
+    async def get_prompt_history(self, cid: str, window: int) -> Dict[str, Any]:
+        """
+        The rolling summary plus every raw message it does not cover yet: at least the last
+        `window` messages, at most 2 * `window` (the summary is refreshed every `window`
+        messages, so the raw tail runs from `window` to 2 * `window` with no gap).
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hget(self._meta_key(cid), "msg_count")
+        pipe.lrange(self._msgs_key(cid), -2 * window, -1)
+        pipe.hmget(self._summary_key(cid), "text", "covered")
+        msg_count, raw_msgs, (summary, covered) = await pipe.execute()
+        total = int(msg_count) if msg_count else len(raw_msgs)
+        first = total - len(raw_msgs)  # absolute index of raw_msgs[0]
+        # drop what the summary already covers, but never cut into the last `window`
+        start = min(max(int(covered) - first, 0) if covered else 0, max(len(raw_msgs) - window, 0))
+        return {
+            "messages": [orjson.loads(m) for m in raw_msgs[start:]],
+            "summary": summary.decode() if summary else None,
+        }
+
+    async def get_summary_state(self, cid: str) -> Dict[str, Any]:
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hget(self._meta_key(cid), "msg_count")
+        pipe.lrange(self._msgs_key(cid), 0, -1)
+        pipe.hgetall(self._summary_key(cid))
+        msg_count, raw_msgs, summary = await pipe.execute()
+        messages = [orjson.loads(m) for m in raw_msgs]
+        return {
+            # total messages ever appended (the list itself is trimmed)
+            "msg_count": int(msg_count) if msg_count else len(messages),
+            "messages": messages,
+            "summary": summary[b"text"].decode() if summary else None,
+            "covered": int(summary[b"covered"]) if summary else 0,
+        }
+
+    async def set_summary(self, cid: str, text: str, covered: int, expected_covered: int) -> bool:
+        """
+        Store a summary of the first `covered` messages, atomically and only if the stored
+        summary still covers `expected_covered` (False: a concurrent refresh got there first).
+        """
+        written = await self._set_summary(
+            keys=[self._summary_key(cid)],
+            args=[text, covered, expected_covered, self.ttl]
+        )
+        return bool(written)
+
+    async def append(
+        self,
+        cid: str,
+        user_msg: Dict[str, Any],
+        asst_msg: Dict[str, Any],
+        fund_id: Optional[int] = None
+    ):
+        """
+        Append a user/assistant exchange, creating the conversation on first use.
+        All writes go out in a single pipeline (one round trip).
+        """
+        now = datetime.utcnow().isoformat()
+        meta_key, msgs_key = self._meta_key(cid), self._msgs_key(cid)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.rpush(msgs_key, orjson.dumps(user_msg), orjson.dumps(asst_msg))
+        pipe.ltrim(msgs_key, -self.max_messages, -1)
+        pipe.hsetnx(meta_key, "fund_id", "" if fund_id is None else str(fund_id))
+        pipe.hsetnx(meta_key, "created_at", now)
+        pipe.hset(meta_key, "updated_at", now)
+        pipe.hincrby(meta_key, "msg_count", 2)
+        pipe.expire(msgs_key, self.ttl)
+        pipe.expire(meta_key, self.ttl)
+        await pipe.execute()
+
+    async def delete(self, cid: str) -> bool:
+        return bool(await self.redis.delete(self._meta_key(cid), self._msgs_key(cid), self._summary_key(cid)))
@@ -9,32 +9,93 @@ Processes PDF/Excel/CSV files:
 """
 
 import io
+import os
 import asyncio
 import traceback
-from typing import Dict, Any, List
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Any, List, Optional
 import pandas as pd
 import re
-import json
+import orjson
+from sqlalchemy import insert
+from langchain.text_splitter import RecursiveCharacterTextSplitter
 from app.core.config import settings
-from langchain_openai import ChatOpenAI
-from langchain_community.llms import Ollama
 
-from app.services.table_parser import TableParser
+from app.services.table_parser import TableParser, classify_table, table_frame
 from app.services.vector_store import VectorStore
+from app.services.semantic_cache import RetrievalPoolCache, SemanticCache, get_local_semantic_cache
+from app.services.llm_client import get_llm
 from app.db.session import SessionLocal
 from app.models.transaction import CapitalCall, Distribution, Adjustment
 
+# optional last-ditch recovery for almost-valid JSON from the LLM
+try:
+    import json_repair
+except Exception:
+    json_repair = None
+
+# PDF/Excel parsing is CPU-bound; run it in worker processes so ingestion neither
+# blocks the event loop nor contends for the GIL with request handling.
+_process_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _get_process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=settings.DOCUMENT_PARSE_WORKERS or os.cpu_count())
+    return _process_pool
+
+
+# ```json ... ``` fences that models add despite being told not to
+_CODE_FENCE_RE = re.compile(r"^```(?:json)?\s*|\s*```$", re.M)
+
+# Transaction section headings (on their own line) and the headings that end the last one
+_SECTION_START_RE = re.compile(r"^[ \t]*(capital calls|distributions|adjustments)[ \t]*:?[ \t]*$", re.I | re.M)
+_SECTION_STOP_RE = re.compile(r"^[ \t]*(performance summary|key definitions|fund strategy|notes)\b", re.I | re.M)
+
+
+def _transaction_sections(text: str) -> str:
+    """
+    Keep only the Capital Calls / Distributions / Adjustments sections so the
+    extraction prompt is a few KB instead of the whole document. Returns the
+    full text when no section heading is found.
+    """
+    starts = list(_SECTION_START_RE.finditer(text))
+    if not starts:
+        return text
+    sections = []
+    for i, m in enumerate(starts):
+        end = starts[i + 1].start() if i + 1 < len(starts) else len(text)
+        stop = _SECTION_STOP_RE.search(text, m.end(), end)
+        sections.append(text[m.start():stop.start() if stop else end].strip())
+    return "\n\n".join(sections)
+
+
+def _to_amount(col: pd.Series) -> pd.Series:
+    """'$5,000,000' / '(1,250.00)' / 5000000 -> float; NaN when not a number."""
+    cleaned = col.astype(str).str.replace(r"[$,\s]", "", regex=True)
+    cleaned = cleaned.str.replace(r"^\((.*)\)$", r"-\1", regex=True)
+    return pd.to_numeric(cleaned, errors="coerce")
+
+
+def _to_date(col: pd.Series) -> pd.Series:
+    """Parse dates to 'YYYY-MM-DD' strings; NaN when unparseable."""
+    return pd.to_datetime(col, errors="coerce", format="mixed").dt.strftime("%Y-%m-%d")
+
+
+def _to_bool(col: pd.Series) -> pd.Series:
+    return col.astype(str).str.strip().str.lower().isin(["yes", "y", "true", "1"])
+
 
 class DocumentProcessor:
     def __init__(self):
         self.table_parser = TableParser()
         self.vector_store = VectorStore()
-        self.llm = self._init_llm()
-
-    def _init_llm(self):
-        if settings.OPENAI_API_KEY:
-            return ChatOpenAI(model=settings.OPENAI_MODEL, temperature=1, openai_api_key=settings.OPENAI_API_KEY)
-        return Ollama(model="llama2:latest", base_url=settings.LLM_BASE_URL)
+        self.llm = get_llm()
+        self.text_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=settings.CHUNK_SIZE,
+            chunk_overlap=settings.CHUNK_OVERLAP
+        )
 
     # ===============================================================
     # MAIN ENTRYPOINT
@@ -53,17 +114,21 @@ class DocumentProcessor:
             "error": None
         }
 
-        db = SessionLocal()
-
         try:
             if not file_bytes:
                 raise ValueError("File is empty or unreadable")
             result["progress"] = 5
 
             # -------------------------------------------------------
-            # 1. Parse tables into normalized rows
+            # 1. Parse tables into normalized rows + extract raw text
+            #    (independent CPU-bound work, run in parallel off the event loop)
             # -------------------------------------------------------
-            tables = self.table_parser.parse(file_bytes, file_type)
+            loop = asyncio.get_running_loop()
+            pool = _get_process_pool()
+            tables, text_content = await asyncio.gather(
+                loop.run_in_executor(pool, self.table_parser.parse, file_bytes, file_type),
+                loop.run_in_executor(pool, self._extract_text, file_bytes, file_type)
+            )
             result["progress"] = 30
 
             if not tables:
@@ -76,23 +141,29 @@ class DocumentProcessor:
             # -------------------------------------------------------
             # 2. Embed text for semantic search
             # -------------------------------------------------------
-            text_content = self._extract_text(file_bytes, file_type)
             if text_content:
-                await self.vector_store.add_document(
-                    content=text_content,
-                    metadata={"document_id": document_id, "fund_id": fund_id}
+                # one batched embedding call + one multi-row insert for all chunks
+                chunks = self.text_splitter.split_text(text_content)
+                await self.vector_store.add_documents(
+                    chunks,
+                    [{"document_id": document_id, "fund_id": fund_id, "chunk_index": i} for i in range(len(chunks))]
                 )
+                # cached answers and retrieval pools no longer reflect this fund's documents
+                get_local_semantic_cache().invalidate(fund_id)
+                await asyncio.gather(SemanticCache().invalidate(fund_id), RetrievalPoolCache().invalidate(fund_id))
             result["progress"] = 75
 
             # -------------------------------------------------------
-            # 3. extract structured JSON from LLM and save to DB
+            # 3. extract transactions (parsed tables first, LLM fallback) and save to DB
             # -------------------------------------------------------
-
-            # extract structured JSON from LLM
-            parsed_transactions = await self._extract_transactions(text_content)
-
-            # save
-            self._save_transactions(db, parsed_transactions, fund_id)
+            parsed_transactions = self._extract_table_transactions(tables)
+            if not any(parsed_transactions.values()):
+                # no structured rows (e.g. PDFs): extract JSON from the LLM, fed only the relevant sections
+                parsed_transactions = await self._extract_transactions(text_content)
+
+            # save (session only lives for the DB work; closing it rolls back on error)
+            with SessionLocal() as db:
+                self._save_transactions(db, parsed_transactions, fund_id)
             result["progress"] = 95
 
             result["status"] = "completed"
@@ -104,41 +175,122 @@ class DocumentProcessor:
             print("[ERROR] Document processing failed:", e)
             traceback.print_exc()
 
-        finally:
-            db.close()
-
         return result
 
     # ===============================================================
     # TEXT EXTRACTION
     # ===============================================================
-    def _extract_text(self, file_bytes: bytes, file_type: str) -> str:
+    @staticmethod
+    def _extract_text(file_bytes: bytes, file_type: str) -> str:
+        # static so it can be pickled into the process pool without the LLM/vector store clients
         if file_type in ["txt", "csv"]:
             return file_bytes.decode("utf-8", errors="ignore")
 
         if file_type in ["xlsx", "xls"]:
-            xls = pd.read_excel(io.BytesIO(file_bytes), sheet_name=None)
-            text = ""
-            for sheet, df in xls.items():
-                text += f"\nSheet: {sheet}\n"
-                text += df.fillna("").to_csv(index=False)
-            return text
+            # one sheet at a time as strings (no NaN fill pass), written into a single buffer
+            buf = io.StringIO()
+            with pd.ExcelFile(io.BytesIO(file_bytes)) as xls:
+                for sheet in xls.sheet_names:
+                    buf.write(f"\nSheet: {sheet}\n")
+                    xls.parse(sheet, dtype=str, na_filter=False).to_csv(buf, index=False)
+            return buf.getvalue()
 
         if file_type == "pdf":
             try:
                 import pdfplumber
-                text = ""
+                parts = []
                 with pdfplumber.open(io.BytesIO(file_bytes)) as pdf:
                     for page in pdf.pages:
-                        text += (page.extract_text() or "") + "\n"
-                return text
+                        parts.append(page.extract_text() or "")
+                return "\n".join(parts) + "\n"
             except:
                 return "PDF text extraction unavailable."
 
         return ""
 
     # ===============================================================
-    # EXTRACT + CLASSIFY TRANSACTIONS
+    # RULE-BASED EXTRACTION FROM PARSED TABLES
+    # ===============================================================
+    # normalized field -> header keywords
+    _FIELD_KEYWORDS = {
+        "date": ("date",),
+        "amount": ("amount",),
+        "type": ("type",),
+        "description": ("description", "note"),
+        "recallable": ("recallable",),
+        "category": ("category",),
+        "contribution": ("contribution",),
+    }
+
+    def _map_columns(self, headers: List[str]) -> Dict[str, str]:
+        cols: Dict[str, str] = {}
+        for h in headers:
+            h_lc = str(h).lower()
+            for field, keywords in self._FIELD_KEYWORDS.items():
+                if field not in cols and any(kw in h_lc for kw in keywords):
+                    cols[field] = h
+                    break
+        return cols
+
+    def _extract_table_transactions(self, tables: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Use each table's category (tagged once by TableParser), then normalize
+        whole columns with pandas and convert to records in one C-level pass
+        (no per-row Python work).
+        """
+        out: Dict[str, List[Dict[str, Any]]] = {"capital_calls": [], "distributions": [], "adjustments": []}
+        for table in tables or []:
+            df = table_frame(table)
+            if df.empty:
+                continue
+            headers = list(df.columns)
+            # tagged by TableParser; classify here only for tables built elsewhere
+            category = table["category"] if "category" in table else classify_table(table.get("sheet", ""), headers)
+            cols = self._map_columns(headers)
+            if category is None or "date" not in cols or "amount" not in cols:
+                continue
+
+            def text_col(field):
+                return df[cols[field]].replace("", None) if field in cols else None
+
+            def flag_col(field):
+                return _to_bool(df[cols[field]]) if field in cols else False
+
+            date, amount = _to_date(df[cols["date"]]), _to_amount(df[cols["amount"]])
+            if category == "capital_calls":
+                frame = pd.DataFrame({
+                    "call_date": date,
+                    "call_type": text_col("type"),
+                    "amount": amount,
+                    "description": text_col("description"),
+                })
+                required = ["call_date", "amount"]
+            elif category == "distributions":
+                frame = pd.DataFrame({
+                    "distribution_date": date,
+                    "distribution_type": text_col("type"),
+                    "is_recallable": flag_col("recallable"),
+                    "amount": amount,
+                    "description": text_col("description"),
+                })
+                required = ["distribution_date", "amount"]
+            else:
+                frame = pd.DataFrame({
+                    "adjustment_date": date,
+                    "adjustment_type": text_col("type"),
+                    "category": text_col("category"),
+                    "amount": amount,
+                    "is_contribution_adjustment": flag_col("contribution"),
+                    "description": text_col("description"),
+                })
+                required = ["adjustment_date", "amount"]
+
+            frame = frame.dropna(subset=required).astype(object)
+            out[category].extend(frame.where(frame.notna(), None).to_dict("records"))
+        return out
+
+    # ===============================================================
+    # EXTRACT + CLASSIFY TRANSACTIONS (LLM)
     # ===============================================================
     async def _extract_transactions(self, text: str) -> Dict[str, Any]:
         PROMPT_TEMPLATE = """
@@ -193,13 +345,11 @@ Do not wrap the JSON in markdown.
 Here is the document text:
 <<<DOCUMENT>>>
 """
-        # call LLM (sync or async)
-        prompt = PROMPT_TEMPLATE.replace("<<<DOCUMENT>>>", text)
+        # call LLM (native async path; does not block the event loop)
+        prompt = PROMPT_TEMPLATE.replace("<<<DOCUMENT>>>", _transaction_sections(text))
+        answer = ""
         try:
-            if asyncio.iscoroutinefunction(self.llm.invoke):
-                resp = await self.llm.invoke(prompt)
-            else:
-                resp = self.llm.invoke(prompt)
+            resp = await self.llm.ainvoke(prompt)
 
             if hasattr(resp, "content"):
                 answer = resp.content
@@ -208,10 +358,16 @@ Here is the document text:
             else:
                 answer = str(resp)
         except Exception as e:
-            print("LLM returned invalid JSON:", answer)
-            raise ValueError("Failed to parse JSON from LLM: " + str(e))
-        
-        parsed_json = json.loads(answer)
+            raise ValueError("LLM transaction extraction failed: " + str(e))
+
+        answer = _CODE_FENCE_RE.sub("", answer.strip())
+        try:
+            parsed_json = orjson.loads(answer)
+        except orjson.JSONDecodeError as e:
+            parsed_json = json_repair.loads(answer) if json_repair is not None else None
+            if not isinstance(parsed_json, dict):
+                print("LLM returned invalid JSON:", answer)
+                raise ValueError("Failed to parse JSON from LLM: " + str(e))
 
         # pastikan keys selalu ada
         return {
@@ -224,38 +380,45 @@ Here is the document text:
     # DB INSERT LOGIC
     # ===============================================================
     def _save_transactions(self, db, data: Dict[str, Any], fund_id: int):
-
-        # CAPITAL CALLS
-        for row in data.get("capital_calls", []):
-            db.add(CapitalCall(
-                call_date=row.get("call_date"),
-                call_type=row.get("call_type"),
-                amount=row.get("amount", 0),
-                description=row.get("description"),
-                fund_id=fund_id
-            ))
-
-        # DISTRIBUTIONS
-        for row in data.get("distributions", []):
-            db.add(Distribution(
-                distribution_date=row.get("distribution_date"),
-                distribution_type=row.get("distribution_type"),
-                is_recallable=row.get("is_recallable", False),
-                amount=row.get("amount", 0),
-                description=row.get("description"),
-                fund_id=fund_id
-            ))
-
-        # ADJUSTMENTS
-        for row in data.get("adjustments", []):
-            db.add(Adjustment(
-                adjustment_date=row.get("adjustment_date"),
-                adjustment_type=row.get("adjustment_type"),
-                category=row.get("category"),
-                is_contribution_adjustment=row.get("is_contribution_adjustment", False),
-                amount=row.get("amount", 0),
-                description=row.get("description"),
-                fund_id=fund_id
-            ))
+        # Plain dicts + Core insert(): SQLAlchemy 2.0 batches these into
+        # multi-row INSERT ... VALUES statements (insertmanyvalues) instead of
+        # one ORM flush per row.
+        caps = [
+            {
+                "call_date": row.get("call_date"),
+                "call_type": row.get("call_type"),
+                "amount": row.get("amount", 0),
+                "description": row.get("description"),
+                "fund_id": fund_id
+            }
+            for row in data.get("capital_calls", [])
+        ]
+        dists = [
+            {
+                "distribution_date": row.get("distribution_date"),
+                "distribution_type": row.get("distribution_type"),
+                "is_recallable": row.get("is_recallable", False),
+                "amount": row.get("amount", 0),
+                "description": row.get("description"),
+                "fund_id": fund_id
+            }
+            for row in data.get("distributions", [])
+        ]
+        adjs = [
+            {
+                "adjustment_date": row.get("adjustment_date"),
+                "adjustment_type": row.get("adjustment_type"),
+                "category": row.get("category"),
+                "is_contribution_adjustment": row.get("is_contribution_adjustment", False),
+                "amount": row.get("amount", 0),
+                "description": row.get("description"),
+                "fund_id": fund_id
+            }
+            for row in data.get("adjustments", [])
+        ]
+
+        for model, rows in ((CapitalCall, caps), (Distribution, dists), (Adjustment, adjs)):
+            if rows:
+                db.execute(insert(model), rows)
 
         db.commit()
@@ -0,0 +1,56 @@
+"""
+Query embedding cache backed by Redis.
+
+Wraps an async embedding function and memoizes its output under
+emb:{model}:{sha256(normalized text)} as raw float32 bytes, so repeated or
+templated questions skip the embedding API call entirely. A small in-process
+LRU sits in front of Redis so exact repeats skip the Redis round trip too.
+"""
+from collections import OrderedDict
+from typing import Awaitable, Callable
+import hashlib
+import numpy as np
+from app.core.config import settings
+from app.db.redis_client import get_redis
+
+
+class CachedEmbedder:
+    def __init__(self, inner: Callable[[str], Awaitable[np.ndarray]], model_name: str, redis=None):
+        self._inner = inner
+        self.model_name = model_name
+        self.redis = redis or get_redis()
+        self.ttl = settings.EMBEDDING_CACHE_TTL
+        self.local_max_entries = settings.EMBEDDING_CACHE_LOCAL_MAX_ENTRIES
+        self._local: "OrderedDict[str, np.ndarray]" = OrderedDict()
+
+    def _remember(self, key: str, vec: np.ndarray) -> np.ndarray:
+        vec.setflags(write=False)  # shared between callers
+        self._local[key] = vec
+        self._local.move_to_end(key)
+        while len(self._local) > self.local_max_entries:
+            self._local.popitem(last=False)
+        return vec
+
+    def _key(self, text: str) -> str:
+        digest = hashlib.sha256(text.strip().lower().encode("utf-8")).hexdigest()
+        return f"emb:{self.model_name}:{digest}"
+
+    async def embed_query(self, text: str) -> np.ndarray:
+        key = self._key(text)
+        local = self._local.get(key)
+        if local is not None:
+            self._local.move_to_end(key)
+            return local
+        try:
+            cached = await self.redis.get(key)
+            if cached is not None:
+                return self._remember(key, np.frombuffer(cached, dtype=np.float32).copy())
+        except Exception as e:
+            print(f"[CachedEmbedder] get error: {e}")
+
+        vec = np.asarray(await self._inner(text), dtype=np.float32)
+        try:
+            await self.redis.set(key, vec.tobytes(), ex=self.ttl)
+        except Exception as e:
+            print(f"[CachedEmbedder] set error: {e}")
+        return self._remember(key, vec)
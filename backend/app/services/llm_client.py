@@ -0,0 +1,144 @@
+"""
+Shared LLM client.
+
+One chat model per process, backed by long-lived HTTP/2 keep-alive pools, so
+RAGEngine and DocumentProcessor reuse connections instead of each paying for
+their own client setup and TLS handshakes. The OpenAI embeddings endpoint gets
+the same treatment through a thin async client (see OpenAIEmbeddingClient).
+"""
+from functools import lru_cache
+from typing import Any, AsyncIterator, List, Optional
+import asyncio
+import base64
+import random
+import httpx
+import numpy as np
+import openai
+import orjson
+from langchain_openai import ChatOpenAI
+from langchain_community.llms import Ollama
+from app.core.config import settings
+
+
+def _http_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=settings.LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.LLM_MAX_KEEPALIVE_CONNECTIONS
+    )
+
+
+@lru_cache(maxsize=1)
+def get_llm():
+    if settings.OPENAI_API_KEY:
+        async_openai = openai.AsyncOpenAI(
+            api_key=settings.OPENAI_API_KEY,
+            http_client=httpx.AsyncClient(http2=True, limits=_http_limits(), timeout=settings.LLM_TIMEOUT)
+        )
+        return ChatOpenAI(
+            model=settings.OPENAI_MODEL,
+            temperature=1,
+            openai_api_key=settings.OPENAI_API_KEY,
+            http_client=httpx.Client(http2=True, limits=_http_limits(), timeout=settings.LLM_TIMEOUT),
+            async_client=async_openai.chat.completions
+        )
+    return Ollama(model="llama2:latest", base_url=settings.LLM_BASE_URL)
+
+
+# the /embeddings endpoint accepts at most this many inputs per request
+EMBEDDING_BATCH_SIZE = 2048
+# transient failures worth retrying: rate limits and server-side errors
+_RETRY_STATUSES = {408, 409, 429} | set(range(500, 600))
+
+
+class OpenAIEmbeddingClient:
+    """
+    Direct POST /embeddings over a shared HTTP/2 keep-alive pool. Same
+    aembed_query/aembed_documents interface as langchain's OpenAIEmbeddings,
+    minus its per-call client plumbing; vectors come back base64-encoded and
+    are decoded straight into float32 arrays. Rate limits, 5xx responses and
+    timeouts are retried with exponential backoff (honoring Retry-After), and at
+    most OPENAI_EMBEDDING_MAX_CONCURRENCY requests are in flight per process.
+    """
+    def __init__(self, api_key: str, model: str):
+        self.model = model
+        self.max_retries = settings.OPENAI_EMBEDDING_MAX_RETRIES
+        self._slots = asyncio.Semaphore(settings.OPENAI_EMBEDDING_MAX_CONCURRENCY)
+        self._http = httpx.AsyncClient(
+            http2=True,
+            base_url=settings.OPENAI_API_BASE,
+            headers={"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"},
+            limits=_http_limits(),
+            timeout=settings.LLM_TIMEOUT
+        )
+
+    @staticmethod
+    def _backoff(attempt: int, response: Optional[httpx.Response]) -> float:
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        try:
+            return min(float(retry_after), 60.0)
+        except (TypeError, ValueError):
+            # full jitter: 0.5s, 1s, 2s, ... caps, spread so retries do not arrive together
+            return random.uniform(0, min(0.5 * 2 ** attempt, 20.0))
+
+    async def _post(self, body: bytes) -> httpx.Response:
+        attempt = 0
+        while True:
+            response = None
+            try:
+                async with self._slots:
+                    response = await self._http.post("/embeddings", content=body)
+                if response.status_code not in _RETRY_STATUSES:
+                    response.raise_for_status()
+                    return response
+                if attempt >= self.max_retries:
+                    response.raise_for_status()
+            except (httpx.TimeoutException, httpx.TransportError) as e:
+                if attempt >= self.max_retries:
+                    raise
+                print(f"[OpenAIEmbeddingClient] request error, retrying: {e}")
+            await asyncio.sleep(self._backoff(attempt, response))
+            attempt += 1
+
+    async def _embed(self, texts: List[str]) -> np.ndarray:
+        r = await self._post(orjson.dumps({
+            "model": self.model,
+            "input": texts,
+            "encoding_format": "base64",
+        }))
+        data = sorted(orjson.loads(r.content)["data"], key=lambda d: d["index"])
+        return np.stack([np.frombuffer(base64.b64decode(d["embedding"]), dtype=np.float32) for d in data])
+
+    async def aembed_documents(self, texts: List[str]) -> np.ndarray:
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        # one request per EMBEDDING_BATCH_SIZE inputs, concurrency bounded by _slots
+        batches = await asyncio.gather(*(
+            self._embed(texts[i:i + EMBEDDING_BATCH_SIZE])
+            for i in range(0, len(texts), EMBEDDING_BATCH_SIZE)
+        ))
+        return np.concatenate(batches)
+
+    async def aembed_query(self, text: str) -> np.ndarray:
+        return (await self._embed([text]))[0]
+
+    async def aclose(self):
+        await self._http.aclose()
+
+
+@lru_cache(maxsize=1)
+def get_embedding_client() -> OpenAIEmbeddingClient:
+    return OpenAIEmbeddingClient(settings.OPENAI_API_KEY, settings.OPENAI_EMBEDDING_MODEL)
+
+
+async def close_embedding_client():
+    """App shutdown: close the embeddings connection pool, if one was opened."""
+    if get_embedding_client.cache_info().currsize:
+        await get_embedding_client().aclose()
+        get_embedding_client.cache_clear()
+
+
+async def astream_text(llm: Any, prompt: Any) -> AsyncIterator[str]:
+    """Yield generated text deltas from the model's native async stream."""
+    async for chunk in llm.astream(prompt):
+        # chat models yield message chunks, plain LLMs yield strings
+        yield getattr(chunk, "content", chunk)
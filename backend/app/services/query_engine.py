@@ -2,26 +2,34 @@
 QueryEngine: orchestrator that classifies intent, optionally computes metrics,
 retrieves RAG answers, and returns combined structured response.
 """
+from functools import lru_cache
 from typing import Dict, Any, List, Optional
-from app.services.rag_engine import RAGEngine
+import re
+from app.services.rag_engine import get_rag_engine
 from app.services.metrics_calculator import MetricsCalculator
 from app.db.session import SessionLocal
 
+# one alternation per intent: a single C-level scan instead of a substring loop per keyword
+CALC_RE = re.compile(r"\b(calculate|what is the|dpi|irr|tvpi|rvpi|pic|paid[- ]in)\b", re.I)
+RET_RE = re.compile(r"\b(show|list|find|when|which|how many)\b", re.I)
+
+
+@lru_cache(maxsize=1024)
+def classify_intent(query: str) -> str:
+    if CALC_RE.search(query):
+        return "calculation"
+    if RET_RE.search(query):
+        return "retrieval"
+    return "general"
+
 class QueryEngine:
     def __init__(self, db=None):
         self.db = db or SessionLocal()
-        self.rag = RAGEngine(db=self.db)
+        self.rag = get_rag_engine()
         self.metrics = MetricsCalculator(self.db)
 
     def _classify_intent(self, query: str) -> str:
-        q = query.lower()
-        calc_keywords = ["calculate", "what is the", "dpi", "irr", "tvpi", "rvpi", "pic", "paid-in"]
-        if any(k in q for k in calc_keywords):
-            return "calculation"
-        ret_keywords = ["show", "list", "find", "when", "which", "how many"]
-        if any(k in q for k in ret_keywords):
-            return "retrieval"
-        return "general"
+        return classify_intent(query)
 
     async def process_query(
         self,
@@ -36,7 +44,7 @@ class QueryEngine:
             # compute metrics and return
             metrics = self.metrics.calculate_all_metrics(fund_id)
             # optionally still ask rag for textual context
-            rag_res = await self.rag.query(query, fund_id=fund_id, conversation_history=conversation_history, top_k=(top_k or 3))
+            rag_res = await self.rag.query(query, fund_id=fund_id, conversation_history=conversation_history, top_k=(top_k or 3), db=self.db)
             return {
                 "answer": rag_res.get("answer"),
                 "sources": rag_res.get("sources"),
@@ -44,7 +52,7 @@ class QueryEngine:
             }
 
         # else general retrieval via RAG
-        rag_res = await self.rag.query(query, fund_id=fund_id, conversation_history=conversation_history, top_k=(top_k or 3))
+        rag_res = await self.rag.query(query, fund_id=fund_id, conversation_history=conversation_history, top_k=(top_k or 3), db=self.db)
         return {
             "answer": rag_res.get("answer"),
             "sources": rag_res.get("sources"),
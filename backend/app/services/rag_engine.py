@@ -3,98 +3,392 @@ RAG Engine: uses VectorStore + LLM + optional SQL metrics to answer queries.
 Supports:
 - top_k and similarity_threshold (from settings or defaults)
 - conversation_history for multi-turn
+- semantic response cache (Redis) for near-duplicate questions
+- retrieval pool cache: over-retrieve once, re-rank locally for related questions
+- bounded history: rolling summary + the (up to 2 * CONVERSATION_HISTORY_WINDOW) messages it does not cover
 """
+from contextlib import suppress
+from functools import lru_cache
 import asyncio
-from typing import List, Dict, Any, Optional
+import re
+from typing import AsyncIterator, List, Dict, Any, Optional
+import numpy as np
+from langchain_core.messages import HumanMessage, SystemMessage
+from sqlalchemy.orm import Session
 from app.core.config import settings
 from app.services.vector_store import VectorStore
+from app.services.batching_retriever import BatchingRetriever
 from app.services.metrics_calculator import MetricsCalculator
-from app.db.session import SessionLocal
-from langchain_openai import ChatOpenAI
-from langchain_community.llms import Ollama
+from app.services.semantic_cache import RetrievalPoolCache, SemanticCache, get_local_semantic_cache
+from app.services.llm_client import astream_text, get_llm
+
+try:
+    import tiktoken
+except Exception:
+    tiktoken = None
 
 TOP_K_DEFAULT = getattr(settings, "RAG_TOP_K_RESULTS", 5)
 SIMILARITY_THRESHOLD = getattr(settings, "SIMILARITY_THRESHOLD", 0.70)
+HISTORY_WINDOW = settings.CONVERSATION_HISTORY_WINDOW
+HISTORY_MESSAGE_MAX_TOKENS = settings.HISTORY_MESSAGE_MAX_TOKENS
+
+# Identical on every call so providers (OpenAI prompt caching, Ollama/vLLM prefix cache)
+# can reuse it; plain-text LLMs receive the messages rendered as one string.
+SYSTEM_PREFIX = (
+    "You are a financial analyst assistant specialized in private equity fund reporting.\n"
+    "Provide a concise, source-cited answer. Cite sources like [Source 1]. "
+    "If numbers are present, show calculation steps when possible."
+)
+RETRIEVAL_POOL_SIZE = settings.RETRIEVAL_POOL_SIZE
+
+
+@lru_cache(maxsize=1)
+def _get_encoding():
+    try:
+        return tiktoken.get_encoding("cl100k_base") if tiktoken is not None else None
+    except Exception:
+        # BPE file unavailable (e.g. offline); fall back to a character estimate
+        return None
+
+
+def _truncate_tokens(text: str, max_tokens: int = HISTORY_MESSAGE_MAX_TOKENS) -> str:
+    enc = _get_encoding()
+    if enc is None:
+        max_chars = max_tokens * 4  # ~4 chars per token for English text
+        return text if len(text) <= max_chars else text[:max_chars] + " ..."
+    tokens = enc.encode(text)
+    return text if len(tokens) <= max_tokens else enc.decode(tokens[:max_tokens]) + " ..."
+
+
+def _format_history(messages: List[Dict[str, str]]) -> str:
+    return "\n".join(
+        f"{m.get('role', 'user').capitalize()}: {_truncate_tokens(m.get('content', ''))}" for m in messages
+    )
+
+
+def _response_text(resp: Any) -> str:
+    if hasattr(resp, "content"):
+        return resp.content
+    if isinstance(resp, dict) and "content" in resp:
+        return resp["content"]
+    return str(resp)
 
 class RAGEngine:
-    def __init__(self, db=None):
-        self.db = db or SessionLocal()
-        self.vector_store = VectorStore(self.db)
-        self.metrics = MetricsCalculator(self.db)
-        self.llm = self._init_llm()
+    """
+    Holds only long-lived clients (vector store/embedder, LLM, cache), so a single
+    instance is shared across requests; the DB session is passed per query.
+    """
+    _METRIC_RE = re.compile(r"\b(dpi|paid[\s-]?in(?:\s+capital)?|pic|irr)\b", re.I)
 
-    def _init_llm(self):
-        if settings.OPENAI_API_KEY:
-            return ChatOpenAI(model=settings.OPENAI_MODEL, temperature=1, openai_api_key=settings.OPENAI_API_KEY)
-        return Ollama(model="llama2:latest", base_url=settings.LLM_BASE_URL)
+    def __init__(self):
+        self.vector_store = VectorStore()
+        # concurrent requests share batched pgvector round trips
+        self.retriever = BatchingRetriever(self.vector_store)
+        self.llm = get_llm()
+        self.cache = SemanticCache()
+        self.local_cache = get_local_semantic_cache()
+        self.pool_cache = RetrievalPoolCache()
 
-    async def query(
+    @classmethod
+    def is_metric_query(cls, question: str) -> bool:
+        return cls._METRIC_RE.search(question) is not None
+
+    @classmethod
+    def _metric_intent(cls, question: str) -> Optional[str]:
+        # one regex pass; DPI/PIC wording takes precedence over IRR when both appear
+        matched = {m.lower() for m in cls._METRIC_RE.findall(question)}
+        if matched - {"irr"}:
+            return "dpi"
+        return "irr" if matched else None
+
+    @staticmethod
+    def _metric_answer(intent: str, fund_id: int, db: Session) -> Optional[Dict[str, Any]]:
+        """Sync SQL (MetricsCalculator); callers run it in a worker thread."""
+        calculator = MetricsCalculator(db)
+        if intent == "dpi":
+            metrics = calculator.calculate_all_metrics(fund_id)
+            answer = f"DPI: {metrics.get('dpi')}, PIC: {metrics.get('pic')}, Total distributions: {metrics.get('total_distributions')}"
+            return {"answer": answer, "sources": [], "metrics": metrics}
+        irr = calculator.calculate_irr(fund_id)
+        if irr is not None:
+            return {"answer": f"IRR: {irr}%", "sources": [], "metrics": None}
+        return None
+
+    @staticmethod
+    async def _discard(task: asyncio.Future):
+        """Cancel a speculative task and reap it (no "exception was never retrieved" noise)."""
+        task.cancel()
+        with suppress(asyncio.CancelledError, Exception):
+            await task
+
+    async def _lookup_or_retrieve(
         self,
         question: str,
-        fund_id: Optional[int] = None,
-        conversation_history: Optional[List[Dict[str, str]]] = None,
-        top_k: int = TOP_K_DEFAULT,
-        similarity_threshold: float = SIMILARITY_THRESHOLD
+        fund_id: Optional[int],
+        top_k: int,
+        query_embedding: Optional[np.ndarray],
+        use_cache: bool
     ) -> Dict[str, Any]:
+        """Cached answer ({"result"}) or retrieved {"candidates", "embedding", "generation"}."""
+        # Multi-turn answers depend on the history, so only standalone questions are cached.
+        # An exact repeat is served from the in-process cache before anything is embedded,
+        # provided no worker has invalidated the fund's answers since it was cached.
+        generation = await self.cache.generation(fund_id) if use_cache else None
+        if use_cache:
+            cached = self.local_cache.lookup_question(question, fund_id, generation)
+            if cached is not None:
+                return {"result": cached}
+
+        # embed once (unless the caller already did); reused for the cache lookups and the vector search
+        qemb = query_embedding if query_embedding is not None else await self.vector_store.embed_query(question)
+        if use_cache:
+            cached = self.local_cache.lookup(qemb, fund_id, generation)
+            if cached is None:
+                cached = await self.cache.lookup(qemb, fund_id)
+                if cached is not None:
+                    self.local_cache.store(question, qemb, fund_id, cached, generation)
+            if cached is not None:
+                return {"result": cached}
+
+        # retrieve candidates (from a cached pool when a similar question was answered recently)
+        candidates = await self._retrieve(question, fund_id, top_k, qemb)
+        return {"candidates": candidates, "embedding": qemb, "generation": generation}
+
+    async def _cache_answer(
+        self,
+        question: str,
+        qemb: np.ndarray,
+        fund_id: Optional[int],
+        result: Dict[str, Any],
+        generation: Optional[int]
+    ):
+        if generation is None:
+            return  # Redis was unreadable when the query started: nothing vouches for freshness
+        self.local_cache.store(question, qemb, fund_id, result, generation)
+        await self.cache.store(qemb, fund_id, result, generation)
 
-        # 1) retrieve candidates
-        candidates = await self.vector_store.similarity_search(question, k=top_k, filter_metadata={"fund_id": fund_id} if fund_id else None)
+    async def _retrieve(self, question: str, fund_id: Optional[int], top_k: int, qemb: np.ndarray) -> List[Dict[str, Any]]:
+        """
+        Top-k candidates for the query. A cached pool from a similar earlier query is
+        re-ranked in-process; otherwise over-retrieve max(top_k, RETRIEVAL_POOL_SIZE)
+        (costs about the same as top_k) and cache the pool for the next related question.
+        """
+        use_pool = settings.SEMANTIC_CACHE_ENABLED
+        generation = None
+        if use_pool:
+            # generation read alongside the lookup: a pool fetched before an upload's
+            # invalidation must not be stored after it
+            generation, pool = await asyncio.gather(
+                self.pool_cache.generation(fund_id),
+                self.pool_cache.lookup(qemb, fund_id)
+            )
+            if pool is not None and pool["k"] >= top_k and pool["docs"]:
+                return self._rerank(pool["docs"], pool["embeddings"], qemb, top_k)
+
+        pool_k = max(top_k, RETRIEVAL_POOL_SIZE) if use_pool else top_k
+        docs = await self.retriever.search(
+            qemb,
+            k=pool_k,
+            fund_id=fund_id or None,
+            include_embeddings=use_pool
+        )
+        if not use_pool:
+            return docs
+
+        embeddings = [d.pop("embedding") for d in docs]
+        if docs and generation is not None:
+            await self.pool_cache.store(
+                qemb, fund_id, {"k": pool_k, "docs": docs, "embeddings": np.vstack(embeddings)}, generation
+            )
+        return docs[:top_k]
+
+    @staticmethod
+    def _rerank(docs: List[Dict[str, Any]], embeddings: np.ndarray, qemb: np.ndarray, top_k: int) -> List[Dict[str, Any]]:
+        q = np.asarray(qemb, dtype=np.float32)
+        norms = np.linalg.norm(embeddings, axis=1) * float(np.linalg.norm(q))
+        sims = (embeddings @ q) / np.where(norms == 0, 1.0, norms)
+        order = np.argsort(-sims)[:top_k]
+        # same scale as the SQL score: 1 - cosine distance
+        return [{**docs[i], "score": float(sims[i])} for i in order]
+
+    async def _prepare(
+        self,
+        question: str,
+        fund_id: Optional[int],
+        conversation_history: Optional[List[Dict[str, str]]],
+        top_k: int,
+        similarity_threshold: float,
+        query_embedding: Optional[np.ndarray],
+        db: Optional[Session],
+        history_summary: Optional[str]
+    ) -> Dict[str, Any]:
+        """
+        Everything before generation. Returns either {"result": ...} when the
+        answer is already known (cache hit / SQL metric answer), or the prompt
+        plus the state needed to finish and cache the answer.
+        """
+        # 0) SQL-driven quick answers for metric queries, decided from the question text alone.
+        # DPI/PIC always has an answer, so nothing is embedded or retrieved for it. IRR may be
+        # unavailable (None), so retrieval runs speculatively alongside it and is cancelled on a hit.
+        intent = self._metric_intent(question) if fund_id is not None and db is not None else None
+        if intent == "dpi":
+            return {"result": await asyncio.to_thread(self._metric_answer, intent, fund_id, db)}
+        use_cache = settings.SEMANTIC_CACHE_ENABLED and not conversation_history
+        if intent == "irr":
+            metric_task = asyncio.ensure_future(asyncio.to_thread(self._metric_answer, intent, fund_id, db))
+            retrieval = asyncio.ensure_future(self._lookup_or_retrieve(question, fund_id, top_k, query_embedding, use_cache))
+            try:
+                metric_result = await metric_task
+            except BaseException:
+                await self._discard(retrieval)
+                raise
+            if metric_result is not None:
+                await self._discard(retrieval)
+                return {"result": metric_result}
+            stage = await retrieval
+        else:
+            stage = await self._lookup_or_retrieve(question, fund_id, top_k, query_embedding, use_cache)
+        if "result" in stage:
+            return stage
+        candidates, qemb = stage["candidates"], stage["embedding"]
 
-        # 2) filter by similarity threshold
-        filtered = [d for d in candidates if (d.get("score") is not None and d["score"] >= similarity_threshold)]
+        # 1) filter by similarity threshold
+        scores = np.fromiter(
+            (-1.0 if d.get("score") is None else d["score"] for d in candidates),
+            dtype=np.float32, count=len(candidates)
+        )
+        filtered = [candidates[i] for i in np.flatnonzero(scores >= similarity_threshold)]
         # fallback: if none pass threshold, keep top 1-3 depending on top_k
         if not filtered:
             filtered = candidates[: min(3, len(candidates))]
+        # deterministic order: the same retrieved set renders the same context (provider prefix-cache hits)
+        filtered.sort(key=lambda d: d.get("id") or 0)
 
-        # 3) prepare context
-        context_text = "\n\n".join([f"[Source {i+1} | score={d.get('score')}]\n{d['content']}" for i,d in enumerate(filtered)]) if filtered else "No relevant documents found."
-
-        # 4) optional SQL-driven quick answers for metric queries
-        sql_answer = None
-        if fund_id is not None:
-            qlower = question.lower()
-            if any(k in qlower for k in ["dpi", "paid-in", "paid in capital", "pic"]):
-                metrics = self.metrics.calculate_all_metrics(fund_id)
-                sql_answer = f"DPI: {metrics.get('dpi')}, PIC: {metrics.get('pic')}, Total distributions: {metrics.get('total_distributions')}"
-            elif "irr" in qlower:
-                irr = self.metrics.calculate_irr(fund_id)
-                if irr is not None:
-                    sql_answer = f"IRR: {irr}%"
-        if sql_answer:
-            return {"answer": sql_answer, "sources": filtered, "metrics": metrics}
-
-        # 5) build prompt with conversation history
-        history_text = ""
+        # 2) prepare context
+        # no per-query values (e.g. scores) here: they would break the cacheable prefix on every question
+        context_text = "\n\n".join([f"[Source {i+1}]\n{d['content']}" for i,d in enumerate(filtered)]) if filtered else "No relevant documents found."
+
+        # 3) build prompt with bounded conversation history (summary + last N messages, each truncated)
+        history_parts = []
+        if history_summary:
+            history_parts.append(f"Summary of earlier conversation: {history_summary}")
         if conversation_history:
-            history_text = "\n".join([f"{m.get('role', 'user').capitalize()}: {m.get('content','')}" for m in conversation_history])
+            # unsummarized tail: HISTORY_WINDOW to 2 * HISTORY_WINDOW messages (see get_prompt_history)
+            history_parts.append(_format_history(conversation_history[-2 * HISTORY_WINDOW:]))
+        history_text = "\n".join(history_parts)
+
+        # invariant system message first, then context -> history -> question (most stable to least)
+        prompt = [
+            SystemMessage(content=SYSTEM_PREFIX),
+            HumanMessage(content=f"""Context:
+{context_text}
 
-        prompt = f"""You are a financial analyst assistant specialized in private equity fund reporting.
 Conversation History:
 {history_text}
 
-Context:
-{context_text}
-
 Question:
 {question}
+"""),
+        ]
+        return {
+            "prompt": prompt, "sources": filtered, "embedding": qemb,
+            "use_cache": use_cache, "generation": stage["generation"]
+        }
 
-Provide a concise, source-cited answer. Cite sources like [Source 1]. If numbers are present, show calculation steps when possible.
-"""
+    async def query(
+        self,
+        question: str,
+        fund_id: Optional[int] = None,
+        conversation_history: Optional[List[Dict[str, str]]] = None,
+        top_k: int = TOP_K_DEFAULT,
+        similarity_threshold: float = SIMILARITY_THRESHOLD,
+        query_embedding: Optional[np.ndarray] = None,
+        db: Optional[Session] = None,
+        history_summary: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        db: request-scoped session, needed for the SQL metric quick answers.
+        history_summary: rolling summary of turns older than conversation_history.
+        """
+        prepared = await self._prepare(
+            question, fund_id, conversation_history, top_k, similarity_threshold,
+            query_embedding, db, history_summary
+        )
+        if "result" in prepared:
+            return prepared["result"]
 
-        # 6) call LLM (sync or async)
+        # 4) call LLM (native async path; does not block the event loop)
         try:
-            if asyncio.iscoroutinefunction(self.llm.invoke):
-                resp = await self.llm.invoke(prompt)
-            else:
-                resp = self.llm.invoke(prompt)
-
-            if hasattr(resp, "content"):
-                answer = resp.content
-            elif isinstance(resp, dict) and "content" in resp:
-                answer = resp["content"]
-            else:
-                answer = str(resp)
+            answer = _response_text(await self.llm.ainvoke(prepared["prompt"]))
         except Exception as e:
-            answer = f"LLM generation error: {e}"
+            return {"answer": f"LLM generation error: {e}", "sources": prepared["sources"]}
+
+        result = {"answer": answer, "sources": prepared["sources"]}
+        if prepared["use_cache"]:
+            await self._cache_answer(question, prepared["embedding"], fund_id, result, prepared["generation"])
+        return result
+
+    async def stream_query(
+        self,
+        question: str,
+        fund_id: Optional[int] = None,
+        conversation_history: Optional[List[Dict[str, str]]] = None,
+        top_k: int = TOP_K_DEFAULT,
+        similarity_threshold: float = SIMILARITY_THRESHOLD,
+        query_embedding: Optional[np.ndarray] = None,
+        db: Optional[Session] = None,
+        history_summary: Optional[str] = None
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Same as query(), but as events: {"sources": [...]} once retrieval is done,
+        {"delta": text} while the LLM generates, then a final
+        {"done": True, "answer": full_answer, "sources": [...]} event.
+        """
+        prepared = await self._prepare(
+            question, fund_id, conversation_history, top_k, similarity_threshold,
+            query_embedding, db, history_summary
+        )
+        if "result" in prepared:
+            result = prepared["result"]
+            yield {"sources": result.get("sources", [])}
+            yield {"delta": result["answer"]}
+            yield {"done": True, **result}
+            return
+
+        yield {"sources": prepared["sources"]}
+        parts: List[str] = []
+        failed = False
+        try:
+            async for delta in astream_text(self.llm, prepared["prompt"]):
+                if delta:
+                    parts.append(delta)
+                    yield {"delta": delta}
+        except Exception as e:
+            failed = True
+            error = f"LLM generation error: {e}"
+            parts.append(error)
+            yield {"delta": error}
+
+        result = {"answer": "".join(parts), "sources": prepared["sources"]}
+        if prepared["use_cache"] and not failed:
+            await self._cache_answer(question, prepared["embedding"], fund_id, result, prepared["generation"])
+        yield {"done": True, **result}
+
+    async def summarize_history(self, previous_summary: Optional[str], messages: List[Dict[str, str]]) -> str:
+        """Fold older messages into the rolling conversation summary."""
+        prompt = f"""Update the running summary of a conversation between a user and a private equity fund analyst assistant.
+Keep fund names, metrics, figures and dates that later questions may refer to. Reply with the summary only, under 150 words.
+
+Current summary:
+{previous_summary or "(none)"}
+
+New messages:
+{_format_history(messages)}
+"""
+        return _response_text(await self.llm.ainvoke(prompt)).strip()
+
 
-        return {"answer": answer, "sources": filtered}
+@lru_cache(maxsize=1)
+def get_rag_engine() -> RAGEngine:
+    """Shared RAGEngine (FastAPI dependency); built once per process."""
+    return RAGEngine()
@@ -0,0 +1,310 @@
+"""
+Semantic response cache backed by Redis.
+
+Caches RAG answers keyed on the query embedding, namespaced per fund, so that
+near-identical questions skip both retrieval and LLM generation.
+
+RetrievalPoolCache reuses the same layout under the `rp` prefix with a looser
+threshold: it keeps the over-retrieved candidate pool (documents + their
+embeddings) of a query, so related questions are re-ranked locally instead of
+hitting the vector store again.
+
+Layout (per namespace `{prefix}:{fund_id|all}`):
+- {ns}:{entry_id}  hash {emb: float32 bytes (L2-normalized), payload: encoded payload}
+- {ns}:recent      zset entry_id -> last access time (bounded LRU window)
+- {ns}:gen         invalidation counter, bumped by invalidate() (never expires); store()
+                   is a compare-and-set on it, so an answer computed before an
+                   invalidation is never written back after it
+
+LocalSemanticCache is a small per-process L1 in front of Redis: exact question
+hits skip even the embedding lookup, near-duplicates are a single in-memory
+matrix product. Other workers' writes reach it only via Redis, so it uses a
+stricter threshold and the same TTL. Each entry is stamped with the namespace's
+{ns}:gen value and is trusted only while that still matches, so an invalidation
+in any worker drops it everywhere.
+"""
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+import hashlib
+import time
+import numpy as np
+import orjson
+from prometheus_client import Counter
+from app.core.config import settings
+from app.db.redis_client import get_redis
+
+CACHE_HITS = Counter("rag_semantic_cache_hits_total", "Semantic cache hits")
+CACHE_MISSES = Counter("rag_semantic_cache_misses_total", "Semantic cache misses")
+POOL_HITS = Counter("rag_retrieval_pool_hits_total", "Retrieval pool cache hits")
+POOL_MISSES = Counter("rag_retrieval_pool_misses_total", "Retrieval pool cache misses")
+LOCAL_HITS = Counter("rag_local_semantic_cache_hits_total", "In-process semantic cache hits")
+
+# KEYS: gen, entry, recent  ARGV: expected gen, emb, payload, ttl, entry_id, now, max_entries
+_STORE_LUA = """
+if tonumber(redis.call('GET', KEYS[1]) or '0') ~= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('HSET', KEYS[2], 'emb', ARGV[2], 'payload', ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+redis.call('ZADD', KEYS[3], ARGV[6], ARGV[5])
+redis.call('ZREMRANGEBYRANK', KEYS[3], 0, -(tonumber(ARGV[7]) + 1))
+redis.call('EXPIRE', KEYS[3], ARGV[4])
+return 1
+"""
+
+
+class SemanticCache:
+    prefix = "sc"
+    hits = CACHE_HITS
+    misses = CACHE_MISSES
+
+    def __init__(self, redis=None, threshold: Optional[float] = None):
+        self.redis = redis or get_redis()
+        self.threshold = threshold if threshold is not None else settings.SEMANTIC_CACHE_THRESHOLD
+        self.ttl = settings.SEMANTIC_CACHE_TTL
+        self.max_entries = settings.SEMANTIC_CACHE_MAX_ENTRIES
+        self._store_script = self.redis.register_script(_STORE_LUA)
+
+    def _namespace(self, fund_id: Optional[int]) -> str:
+        return f"{self.prefix}:{fund_id if fund_id is not None else 'all'}"
+
+    async def generation(self, fund_id: Optional[int] = None) -> Optional[int]:
+        """Invalidation counter of the namespace; None when Redis cannot be read."""
+        try:
+            gen = await self.redis.get(f"{self._namespace(fund_id)}:gen")
+            return int(gen) if gen else 0
+        except Exception as e:
+            print(f"[{type(self).__name__}] generation error: {e}")
+            return None
+
+    def _encode(self, payload: Dict[str, Any]) -> bytes:
+        return orjson.dumps(payload)
+
+    def _decode(self, blob: bytes) -> Dict[str, Any]:
+        return orjson.loads(blob)
+
+    @staticmethod
+    def _normalize(embedding: np.ndarray) -> Optional[np.ndarray]:
+        vec = np.asarray(embedding, dtype=np.float32)
+        norm = float(np.linalg.norm(vec))
+        if norm == 0.0:
+            # dummy (zero) embeddings carry no signal; never match on them
+            return None
+        return vec / norm
+
+    async def lookup(self, embedding: np.ndarray, fund_id: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        qvec = self._normalize(embedding)
+        if qvec is None:
+            return None
+        ns = self._namespace(fund_id)
+        recent_key = f"{ns}:recent"
+        try:
+            entry_ids = [e.decode() for e in await self.redis.zrevrange(recent_key, 0, self.max_entries - 1)]
+            if not entry_ids:
+                self.misses.inc()
+                return None
+
+            pipe = self.redis.pipeline(transaction=False)
+            for eid in entry_ids:
+                pipe.hget(f"{ns}:{eid}", "emb")
+            blobs = await pipe.execute()
+
+            live_ids, vecs, expired = [], [], []
+            for eid, blob in zip(entry_ids, blobs):
+                if blob is None:
+                    expired.append(eid)
+                elif len(blob) == qvec.nbytes:
+                    live_ids.append(eid)
+                    vecs.append(blob)
+            if expired:
+                await self.redis.zrem(recent_key, *expired)
+            if not vecs:
+                self.misses.inc()
+                return None
+
+            # stored vectors are normalized, so the dot product is the cosine similarity
+            mat = np.frombuffer(b"".join(vecs), dtype=np.float32).reshape(len(vecs), -1)
+            sims = mat @ qvec
+            best = int(np.argmax(sims))
+            if sims[best] < self.threshold:
+                self.misses.inc()
+                return None
+
+            payload = await self.redis.hget(f"{ns}:{live_ids[best]}", "payload")
+            if payload is None:
+                self.misses.inc()
+                return None
+            await self.redis.zadd(recent_key, {live_ids[best]: time.time()})
+            self.hits.inc()
+            return self._decode(payload)
+        except Exception as e:
+            print(f"[{type(self).__name__}] lookup error: {e}")
+            return None
+
+    async def store(
+        self,
+        embedding: np.ndarray,
+        fund_id: Optional[int],
+        payload: Dict[str, Any],
+        generation: int
+    ):
+        """
+        generation: the namespace's generation() read before the payload was computed;
+        the write is dropped if an invalidation has bumped it since.
+        """
+        qvec = self._normalize(embedding)
+        if qvec is None:
+            return
+        ns = self._namespace(fund_id)
+        recent_key = f"{ns}:recent"
+        entry_id = hashlib.sha1(qvec.tobytes()).hexdigest()
+        entry_key = f"{ns}:{entry_id}"
+        try:
+            # atomic: check {ns}:gen, then write the entry and trim the LRU window
+            # (only the most recently used max_entries stay searchable)
+            await self._store_script(
+                keys=[f"{ns}:gen", entry_key, recent_key],
+                args=[generation, qvec.tobytes(), self._encode(payload), self.ttl,
+                      entry_id, time.time(), self.max_entries]
+            )
+        except Exception as e:
+            print(f"[{type(self).__name__}] store error: {e}")
+
+    async def invalidate(self, fund_id: Optional[int] = None):
+        """
+        Drop cached answers for a fund (and the cross-fund namespace) after new documents land,
+        and bump their generation counters so every worker's LocalSemanticCache drops them too.
+        """
+        namespaces = [self._namespace(None)]
+        if fund_id is not None:
+            namespaces.append(self._namespace(fund_id))
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.delete(*(f"{ns}:recent" for ns in namespaces))
+            for ns in namespaces:
+                pipe.incr(f"{ns}:gen")
+            await pipe.execute()
+        except Exception as e:
+            print(f"[{type(self).__name__}] invalidate error: {e}")
+
+
+class RetrievalPoolCache(SemanticCache):
+    """
+    Payload: {"k": pool size, "docs": [...], "embeddings": float32 matrix (one row per doc)}.
+    Stored as a length-prefixed JSON header followed by the raw matrix bytes.
+    """
+    prefix = "rp"
+    hits = POOL_HITS
+    misses = POOL_MISSES
+
+    def __init__(self, redis=None, threshold: Optional[float] = None):
+        super().__init__(redis, threshold if threshold is not None else settings.RETRIEVAL_POOL_THRESHOLD)
+
+    def _encode(self, payload: Dict[str, Any]) -> bytes:
+        head = orjson.dumps({"k": payload["k"], "docs": payload["docs"]})
+        mat = np.ascontiguousarray(payload["embeddings"], dtype=np.float32)
+        return len(head).to_bytes(4, "big") + head + mat.tobytes()
+
+    def _decode(self, blob: bytes) -> Dict[str, Any]:
+        n = int.from_bytes(blob[:4], "big")
+        head = orjson.loads(blob[4:4 + n])
+        mat = np.frombuffer(blob[4 + n:], dtype=np.float32)
+        head["embeddings"] = mat.reshape(len(head["docs"]), -1) if head["docs"] else mat.reshape(0, 0)
+        return head
+
+
+class LocalSemanticCache:
+    """
+    LRU of {fund_id, emb, payload, ts, gen} keyed by (fund_id, question hash), plus a
+    lazily rebuilt (N, dim) matrix of the normalized embeddings for cosine lookups.
+    Callers pass the namespace's current SemanticCache.generation(); entries stamped
+    with another generation are stale, and None (Redis unreadable) bypasses the cache.
+    Methods never await, so each call is atomic on the event loop.
+    """
+    def __init__(self, max_entries: Optional[int] = None, threshold: Optional[float] = None, ttl: Optional[int] = None):
+        self.max_entries = max_entries or settings.SEMANTIC_CACHE_LOCAL_MAX_ENTRIES
+        self.threshold = threshold if threshold is not None else settings.SEMANTIC_CACHE_LOCAL_THRESHOLD
+        self.ttl = ttl or settings.SEMANTIC_CACHE_TTL
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._mat = np.zeros((0, 0), dtype=np.float32)
+        self._keys: List[str] = []
+        self._funds: List[Optional[int]] = []
+        self._dirty = False
+
+    @staticmethod
+    def _key(question: str, fund_id: Optional[int]) -> str:
+        digest = hashlib.sha256(question.strip().lower().encode("utf-8")).hexdigest()
+        return f"{fund_id if fund_id is not None else 'all'}:{digest}"
+
+    def _live(self, key: str, generation: Optional[int]) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(key)
+        if entry is None or generation is None:
+            return None
+        if entry["gen"] != generation or time.time() - entry["ts"] > self.ttl:
+            self._drop(key)
+            return None
+        self._entries.move_to_end(key)
+        LOCAL_HITS.inc()
+        return entry["payload"]
+
+    def _drop(self, key: str):
+        if self._entries.pop(key, None) is not None:
+            self._dirty = True
+
+    def _rebuild(self):
+        self._keys = list(self._entries)
+        self._funds = [self._entries[k]["fund_id"] for k in self._keys]
+        self._mat = np.vstack([self._entries[k]["emb"] for k in self._keys]) if self._keys else np.zeros((0, 0), dtype=np.float32)
+        self._dirty = False
+
+    def lookup_question(self, question: str, fund_id: Optional[int], generation: Optional[int]) -> Optional[Dict[str, Any]]:
+        """Exact (normalized) question match; needs no embedding."""
+        return self._live(self._key(question, fund_id), generation)
+
+    def lookup(self, embedding: np.ndarray, fund_id: Optional[int], generation: Optional[int]) -> Optional[Dict[str, Any]]:
+        qvec = SemanticCache._normalize(embedding)
+        if qvec is None or generation is None or not self._entries:
+            return None
+        if self._dirty:
+            self._rebuild()
+        if self._mat.shape[1] != qvec.shape[0]:
+            return None
+        sims = self._mat @ qvec
+        sims[np.asarray([f != fund_id for f in self._funds])] = -1.0
+        best = int(np.argmax(sims))
+        if sims[best] < self.threshold:
+            return None
+        return self._live(self._keys[best], generation)
+
+    def store(
+        self,
+        question: str,
+        embedding: np.ndarray,
+        fund_id: Optional[int],
+        payload: Dict[str, Any],
+        generation: Optional[int]
+    ):
+        """generation: read before the payload was computed, so a concurrent invalidation wins."""
+        qvec = SemanticCache._normalize(embedding)
+        if qvec is None or generation is None:
+            return
+        key = self._key(question, fund_id)
+        self._entries[key] = {"fund_id": fund_id, "emb": qvec, "payload": payload, "ts": time.time(), "gen": generation}
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        self._dirty = True
+
+    def invalidate(self, fund_id: Optional[int] = None):
+        """
+        Same scope as SemanticCache.invalidate: the fund's entries and cross-fund ones.
+        Immediate for this process; other workers notice the bumped generation.
+        """
+        for key in [k for k, e in self._entries.items() if e["fund_id"] is None or e["fund_id"] == fund_id]:
+            self._drop(key)
+
+
+@lru_cache(maxsize=1)
+def get_local_semantic_cache() -> LocalSemanticCache:
+    return LocalSemanticCache()
@@ -1,14 +1,81 @@
 """
 Table parsing service for document ingestion.
-Normalizes tables into a consistent list-of-dicts format:
-[ { "sheet": "...", "rows": [ {col: val}, ... ] }, ... ]
+Normalizes tables into a consistent columnar format:
+[ { "sheet": "...", "category": "capital_calls"|"distributions"|"adjustments"|None,
+    "table": pa.Table }, ... ]
+With pyarrow installed each table is one set of contiguous Arrow buffers: no
+per-cell Python objects, pickled back from the parse worker as raw buffers, and
+to_pandas()/to_pylist() only materialize values when a caller asks for them.
+Without pyarrow (or when a column mixes types Arrow cannot hold) the table is
+{"columns": [col, ...], "data": {col: [val, ...]}} instead; table_frame() reads both.
 Supports: pdf, xlsx/xls, csv, txt
 """
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 import io
 import re
 import pandas as pd
 
+# arrow-backed CSV parsing is multi-threaded and several times faster; optional
+try:
+    import pyarrow as pa
+    CSV_ENGINE = "pyarrow"
+except Exception:
+    pa = None
+    CSV_ENGINE = "c"
+
+# text tables: columns separated by two-or-more spaces or a tab
+_SPLIT_RE = re.compile(r"\s{2,}|\t")
+
+# table category patterns, highest priority first; one regex pass per label.
+# Whole words only ("Recallable" is not a call; "_" and "-" separate words, so sheet
+# names like "capital_calls" still match), and specific phrases before the generic
+# capital/call ones ("Return of Capital" is a distribution column).
+_CATEGORY_KEYWORDS = (
+    (r"capital[\s_-]+calls?", "capital_calls"),
+    (r"distributions?", "distributions"),
+    (r"return[\s_-]+of[\s_-]+capital", "distributions"),
+    (r"recallable", "distributions"),
+    (r"adjustments?", "adjustments"),
+    (r"calls?", "capital_calls"),
+    (r"capital", "capital_calls"),
+)
+_CATEGORY_RE = re.compile(
+    "|".join(rf"(?<![a-z0-9])({kw})(?![a-z0-9])" for kw, _ in _CATEGORY_KEYWORDS), re.I
+)
+
+
+def classify_table(sheet: Any, headers: List[Any]) -> Optional[str]:
+    """Pick the table's category ONCE from its sheet name, then its header row."""
+    for label in (str(sheet), " ".join(map(str, headers))):
+        hits = [m.lastindex for m in _CATEGORY_RE.finditer(label)]
+        if hits:
+            return _CATEGORY_KEYWORDS[min(hits) - 1][1]
+    return None
+
+
+def _columnar(sheet: str, df: pd.DataFrame) -> Dict[str, Any]:
+    columns = df.columns.tolist()
+    out = {"sheet": sheet, "category": classify_table(sheet, columns)}
+    if pa is not None:
+        try:
+            # blanks stay Arrow nulls; table_frame() turns them back into ""
+            out["table"] = pa.Table.from_pandas(df, preserve_index=False)
+            return out
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            pass  # e.g. an Excel column holding both numbers and text
+    df = df.fillna("")
+    out["columns"] = columns
+    out["data"] = {c: df[c].tolist() for c in columns}
+    return out
+
+
+def table_frame(table: Dict[str, Any]) -> pd.DataFrame:
+    """DataFrame view of a parsed table, blanks as "" in either storage format."""
+    if table.get("table") is not None:
+        return table["table"].to_pandas().fillna("")
+    return pd.DataFrame(table.get("data") or {}, columns=table.get("columns"))
+
+
 class TableParser:
     def __init__(self):
         pass
@@ -34,30 +101,36 @@ class TableParser:
         tables: List[Dict[str, Any]] = []
         data = pd.read_excel(io.BytesIO(file_bytes), sheet_name=None)
         for sheet_name, df in data.items():
-            rows = df.fillna("").to_dict(orient="records")
-            tables.append({"sheet": sheet_name, "rows": rows})
+            tables.append(_columnar(sheet_name, df))
         return tables
 
     def _parse_csv(self, file_bytes: bytes) -> List[Dict[str, Any]]:
-        df = pd.read_csv(io.BytesIO(file_bytes))
-        rows = df.fillna("").to_dict(orient="records")
-        return [{"sheet": "csv", "rows": rows}]
+        try:
+            df = pd.read_csv(io.BytesIO(file_bytes), engine=CSV_ENGINE)
+        except Exception:
+            if CSV_ENGINE == "c":
+                raise
+            # the arrow reader is stricter (e.g. ragged rows); retry with the C parser
+            df = pd.read_csv(io.BytesIO(file_bytes))
+        return [_columnar("csv", df)]
 
     def _parse_text(self, file_bytes: bytes) -> List[Dict[str, Any]]:
         text = file_bytes.decode("utf-8", errors="ignore")
-        lines = [ln for ln in text.splitlines() if ln.strip()]
-        if not lines:
+        split = _SPLIT_RE.split
+        split_lines = [split(ln) for ln in map(str.strip, text.splitlines()) if ln]
+        if not split_lines:
             return []
-        # split on two-or-more spaces or tabs
-        split_lines = [re.split(r"\s{2,}|\t", ln.strip()) for ln in lines]
         headers = split_lines[0]
-        rows = []
-        for row in split_lines[1:]:
-            if len(row) != len(headers):
-                # try pad/truncate
-                if len(row) < len(headers):
-                    row += [""] * (len(headers) - len(row))
-                else:
-                    row = row[: len(headers)]
-            rows.append({headers[i]: row[i] for i in range(len(headers))})
-        return [{"sheet": "text", "rows": rows}]
+        width = len(headers)
+        # pad/truncate each row to the header width, then transpose into columns
+        rows = [(row + [""] * (width - len(row)))[:width] for row in split_lines[1:]]
+        columns = list(zip(*rows)) if rows else [()] * width
+        out = {"sheet": "text", "category": classify_table("text", headers)}
+        if pa is not None:
+            out["table"] = pa.Table.from_arrays(
+                [pa.array(col, type=pa.string()) for col in columns], names=headers
+            )
+        else:
+            out["columns"] = headers
+            out["data"] = {h: list(col) for h, col in zip(headers, columns)}
+        return [out]
@@ -3,16 +3,56 @@ Vector store service using pgvector (PostgreSQL extension)
 
 Provides:
 - add_document(content, metadata)
-- similarity_search(query, k, filter_metadata)
+- add_documents(contents, metadatas)
+- embed_query(text)
+- similarity_search(query, k, filter_metadata, embedding, include_embeddings)
+- similarity_search_batch(embeddings, k, fund_ids, include_embeddings, document_ids)
+- similarity_search_many(queries, k, filter_metadata)
 - clear(fund_id)
 """
 from typing import List, Dict, Any, Optional
 import json
 import numpy as np
-import asyncio
+import orjson
 from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import JSONB
 from app.core.config import settings
-from app.db.session import SessionLocal
+from app.db.session import AsyncSessionLocal, SessionLocal
+from app.services.embedding_cache import CachedEmbedder
+from app.services.llm_client import get_embedding_client
+
+# rows per multi-row INSERT statement (keeps the bind-parameter count bounded)
+INSERT_BATCH_SIZE = 200
+# every vector index this module has created; _create_schema keeps the one matching the server
+VECTOR_INDEXES = (
+    "document_embeddings_embedding_idx",
+    "document_embeddings_embedding_hnsw_idx",
+    "document_embeddings_embedding_h_hnsw_idx",
+    "document_embeddings_embedding_ip_idx",
+    "document_embeddings_embedding_ip_hnsw_idx",
+    "document_embeddings_embedding_h_ip_hnsw_idx",
+)
+# halfvec servers: the FP16 index pass fetches this many candidates per result, re-ranked in full precision
+HALFVEC_RERANK_FACTOR = 10
+
+
+def _normalize(vecs: np.ndarray) -> np.ndarray:
+    """L2-normalize along the last axis (zero vectors stay zero)."""
+    vecs = np.asarray(vecs, dtype=np.float32)
+    return vecs / (np.linalg.norm(vecs, axis=-1, keepdims=True) + 1e-12)
+
+
+def _vector_param(vec: np.ndarray) -> np.ndarray:
+    # bound as-is: the asyncpg pgvector codec sends it in binary
+    return np.ascontiguousarray(vec, dtype=np.float32)
+
+
+def _vector_literal(vec: np.ndarray) -> str:
+    """
+    pgvector text form '[x,y,...]', for vector[] parameters (asyncpg would treat a
+    list of arrays as a 2-D float array). orjson serializes the float32 buffer in C.
+    """
+    return orjson.dumps(np.ascontiguousarray(vec, dtype=np.float32), option=orjson.OPT_SERIALIZE_NUMPY).decode()
 
 # Choose embedding backend wrappers as available in your environment.
 # We attempt to use OpenAIEmbeddings or HuggingFaceEmbeddings if present; fallback to dummy.
@@ -25,26 +65,71 @@ try:
 except Exception:
     HuggingFaceEmbeddings = None
 
+def _row_to_doc(row, include_embeddings: bool = False) -> Dict[str, Any]:
+    score = row["similarity_score"]
+    doc = {
+        "id": row["id"],
+        "document_id": row["document_id"],
+        "fund_id": row["fund_id"],
+        "content": row["content"],
+        "metadata": row["metadata"],
+        "score": float(score) if score is not None else None
+    }
+    if include_embeddings:
+        # decoded from pgvector's binary format by the asyncpg codec
+        doc["embedding"] = np.asarray(row["embedding"], dtype=np.float32)
+    return doc
+
+
 class VectorStore:
-    def __init__(self, db=None):
-        self.db = db or SessionLocal()
+    """
+    Stateless apart from the embedding client: every DB operation opens its own
+    short-lived session, so one instance can be shared across concurrent requests.
+    Searches and inserts run on the asyncpg engine; schema setup and clear() stay sync.
+    """
+    # schema setup runs once per process (first instance, normally at app startup)
+    _schema_ready: bool = False
+    # set by _create_schema when the server supports halfvec (pgvector >= 0.7)
+    halfvec: bool = False
+
+    def __init__(self, embedder=None):
         # choose embedding model and dimension
-        if settings.OPENAI_API_KEY and OpenAIEmbeddings is not None:
+        if settings.OPENAI_API_KEY and settings.OPENAI_EMBEDDINGS_DIRECT:
+            self.embeddings = get_embedding_client()
+            self.dimension = 1536
+            model_name = settings.OPENAI_EMBEDDING_MODEL
+        elif settings.OPENAI_API_KEY and OpenAIEmbeddings is not None:
             self.embeddings = OpenAIEmbeddings(model=settings.OPENAI_EMBEDDING_MODEL, openai_api_key=settings.OPENAI_API_KEY)
             self.dimension = 1536
+            model_name = settings.OPENAI_EMBEDDING_MODEL
         elif HuggingFaceEmbeddings is not None:
             self.embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
             self.dimension = 384
+            model_name = "all-MiniLM-L6-v2"
         else:
             self.embeddings = None
             self.dimension = getattr(settings, "EMBED_DIM", 384)
+            model_name = None
+
+        # query embeddings are cached by text hash; dummy (zero) embeddings are not worth caching
+        if embedder is None and model_name is not None:
+            embedder = CachedEmbedder(self._compute_embedding, model_name)
+        self.embedder = embedder
 
         # ensure pgvector extension and table exist
-        self._ensure_extension_and_table()
+        if not VectorStore._schema_ready:
+            self._ensure_extension_and_table()
 
     def _ensure_extension_and_table(self):
+        with SessionLocal() as db:
+            # left unset on failure so the next instance retries
+            VectorStore._schema_ready = self._create_schema(db)
+
+    def _create_schema(self, db) -> bool:
         try:
-            self.db.execute(text("CREATE EXTENSION IF NOT EXISTS vector"))
+            # savepoint: a failed CREATE EXTENSION must not abort the rest of the setup
+            with db.begin_nested():
+                db.execute(text("CREATE EXTENSION IF NOT EXISTS vector"))
         except Exception:
             # extension may need superuser; ignore if fails
             pass
@@ -61,108 +146,227 @@ class VectorStore:
         );
         """
         try:
-            self.db.execute(text(create_table_sql))
-            # create ivfflat index if not exists (note: may need REINDEX after populate)
-            try:
-                self.db.execute(text("""
-                CREATE INDEX IF NOT EXISTS document_embeddings_embedding_idx
-                ON document_embeddings USING ivfflat (embedding vector_cosine_ops)
-                WITH (lists = 100);
-                """))
-            except Exception:
-                pass
-            self.db.commit()
+            db.execute(text(create_table_sql))
+            # Stored vectors are L2-normalized (older rows: init_db's normalize_embeddings
+            # migration), so indexes use inner product (vector_ip_ops):
+            # one dot product per comparison instead of cosine's extra norms.
+            # HNSW (pgvector >= 0.5): logarithmic graph search, no REINDEX after bulk loads.
+            # Older servers keep an ivfflat index (may need REINDEX after populate).
+            # pgvector >= 0.7: index the FP16 (halfvec) cast instead; half the bytes per scanned
+            # vector, and searches re-rank the coarse candidates against the full-precision column.
+            version = self._pgvector_version(db)
+            use_halfvec = version >= (0, 7)
+            if use_halfvec:
+                index_name = "document_embeddings_embedding_h_ip_hnsw_idx"
+                index_def = f"hnsw ((embedding::halfvec({self.dimension})) halfvec_ip_ops) WITH (m = 16, ef_construction = 64)"
+            elif version >= (0, 5):
+                index_name = "document_embeddings_embedding_ip_hnsw_idx"
+                index_def = "hnsw (embedding vector_ip_ops) WITH (m = 16, ef_construction = 64)"
+            else:
+                index_name = "document_embeddings_embedding_ip_idx"
+                index_def = "ivfflat (embedding vector_ip_ops) WITH (lists = 100)"
+            db.execute(text(f"CREATE INDEX IF NOT EXISTS {index_name} ON document_embeddings USING {index_def}"))
+            for name in VECTOR_INDEXES:
+                if name != index_name:
+                    db.execute(text(f"DROP INDEX IF EXISTS {name}"))
+            db.commit()
         except Exception as e:
             print(f"[VectorStore] ensure table error: {e}")
-            self.db.rollback()
+            db.rollback()
+            return False
+        # only once the matching index is committed: searches cast to halfvec when this is set
+        VectorStore.halfvec = use_halfvec
+        return True
+
+    @staticmethod
+    def _pgvector_version(db) -> tuple:
+        version = db.execute(text("SELECT extversion FROM pg_extension WHERE extname = 'vector'")).scalar()
+        return tuple(int(p) for p in version.split(".")[:2]) if version else (0, 0)
+
+    async def _set_ef_search(self, db, k: int):
+        # transaction-local HNSW candidate list size, scaled with k (placeholder GUC on ivfflat servers);
+        # must cover the coarse candidate count on halfvec servers
+        ef = max(40, 4 * k, HALFVEC_RERANK_FACTOR * k if self.halfvec else 0)
+        await db.execute(text("SELECT set_config('hnsw.ef_search', :ef, true)"), {"ef": str(ef)})
+
+    def _knn_source(self, where_clause: str, query_vec: str, k_param: str) -> str:
+        """
+        FROM source (aliased `e`) for a top-k scan ordered by `e.embedding <#> query`.
+        On halfvec servers it is a coarse pass over the FP16 index returning
+        HALFVEC_RERANK_FACTOR * k candidates; the caller's ORDER BY re-ranks them exactly.
+        """
+        if not self.halfvec:
+            return f"document_embeddings e {where_clause}"
+        half = f"halfvec({self.dimension})"
+        return f"""(
+            SELECT e.* FROM document_embeddings e
+            {where_clause}
+            ORDER BY e.embedding::{half} <#> CAST({query_vec} AS vector)::{half}
+            LIMIT {HALFVEC_RERANK_FACTOR} * {k_param}
+        ) e"""
 
     async def _compute_embedding(self, text: str) -> np.ndarray:
-        # run embedding in thread to avoid blocking event loop
         if self.embeddings is None:
             # dummy random vector (not ideal in production)
             return np.zeros(self.dimension, dtype=np.float32)
-        def sync_embed():
-            # compatible with different embedding wrappers
-            if hasattr(self.embeddings, "embed_query"):
-                return self.embeddings.embed_query(text)
-            if hasattr(self.embeddings, "encode"):
-                return self.embeddings.encode(text)
-            # fallback
-            return np.zeros(self.dimension, dtype=np.float32)
-        loop = asyncio.get_running_loop()
-        result = await loop.run_in_executor(None, sync_embed)
-        return np.array(result, dtype=np.float32)
+        # langchain's async API: native HTTP for OpenAI, a worker thread for local (CPU-bound) models
+        return _normalize(await self.embeddings.aembed_query(text))
+
+    async def embed_query(self, text: str) -> np.ndarray:
+        """Embed a query once so callers can reuse it (cache lookups, similarity_search)."""
+        if self.embedder is not None:
+            return await self.embedder.embed_query(text)
+        return await self._compute_embedding(text)
+
+    async def _compute_embeddings(self, texts: List[str]) -> np.ndarray:
+        """Embed many texts in one call (OpenAI: one /embeddings request per 2048 inputs)."""
+        if self.embeddings is None:
+            return np.zeros((len(texts), self.dimension), dtype=np.float32)
+        result = await self.embeddings.aembed_documents(texts)
+        return _normalize(np.array(result, dtype=np.float32).reshape(len(texts), -1))
 
     async def add_document(self, content: str, metadata: Dict[str, Any]):
+        return await self.add_documents([content], [metadata])
+
+    async def add_documents(self, contents: List[str], metadatas: List[Dict[str, Any]]):
+        """Embed all contents in one batch and insert them with multi-row INSERTs in a single transaction."""
+        if not contents:
+            return True
         try:
-            emb = await self._compute_embedding(content)
-            emb_str = "[" + ",".join(map(str, emb.tolist())) + "]"
-            insert_sql = text("""
-                INSERT INTO document_embeddings (document_id, fund_id, content, embedding, metadata)
-                VALUES (:document_id, :fund_id, :content, :embedding, :metadata)
-            """)
-            params = {
-                "document_id": metadata.get("document_id"),
-                "fund_id": metadata.get("fund_id"),
-                "content": content,
-                "embedding": emb_str,
-                "metadata": json.dumps(metadata)
-            }
-            self.db.execute(insert_sql, params)
-            self.db.commit()
+            embs = await self._compute_embeddings(contents)
+            statements = []
+            for start in range(0, len(contents), INSERT_BATCH_SIZE):
+                values, params = [], {}
+                for i in range(start, min(start + INSERT_BATCH_SIZE, len(contents))):
+                    values.append(f"(:document_id{i}, :fund_id{i}, :content{i}, :embedding{i}, :metadata{i})")
+                    params.update({
+                        f"document_id{i}": metadatas[i].get("document_id"),
+                        f"fund_id{i}": metadatas[i].get("fund_id"),
+                        f"content{i}": contents[i],
+                        f"embedding{i}": _vector_param(embs[i]),
+                        f"metadata{i}": json.dumps(metadatas[i])
+                    })
+                statements.append((text(f"""
+                    INSERT INTO document_embeddings (document_id, fund_id, content, embedding, metadata)
+                    VALUES {", ".join(values)}
+                """), params))
+            async with AsyncSessionLocal() as db, db.begin():
+                for sql, params in statements:
+                    await db.execute(sql, params)
             return True
         except Exception as e:
-            print(f"[VectorStore] add_document error: {e}")
-            self.db.rollback()
+            print(f"[VectorStore] add_documents error: {e}")
             raise
 
-    async def similarity_search(self, query: str, k: int = 5, filter_metadata: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
-        try:
-            qemb = await self._compute_embedding(query)
-            emb_str = "[" + ",".join(map(str, qemb.tolist())) + "]"
-            params = {"embedding": emb_str, "k": k}
-            where_clause = ""
-            if filter_metadata:
-                conds = []
-                for kf, vf in filter_metadata.items():
-                    if kf in ("fund_id", "document_id"):
-                        conds.append(f"{kf} = :{kf}")
-                        params[kf] = vf
-                if conds:
-                    where_clause = "WHERE " + " AND ".join(conds)
+    async def similarity_search(
+        self,
+        query: str,
+        k: int = 5,
+        filter_metadata: Optional[Dict[str, Any]] = None,
+        embedding: Optional[np.ndarray] = None,
+        include_embeddings: bool = False
+    ) -> List[Dict[str, Any]]:
+        """
+        Single search, as a one-query similarity_search_batch (one copy of the SQL).
+        include_embeddings adds each document's vector under "embedding" (for local re-ranking).
+        """
+        qemb = embedding if embedding is not None else await self.embed_query(query)
+        filters = filter_metadata or {}
+        results = await self.similarity_search_batch(
+            [qemb],
+            k=k,
+            fund_ids=[filters.get("fund_id")],
+            include_embeddings=include_embeddings,
+            document_ids=[filters.get("document_id")]
+        )
+        return results[0]
 
+    async def similarity_search_batch(
+        self,
+        embeddings: List[np.ndarray],
+        k: int = 5,
+        fund_ids: Optional[List[Optional[int]]] = None,
+        include_embeddings: bool = False,
+        document_ids: Optional[List[Optional[int]]] = None
+    ) -> List[List[Dict[str, Any]]]:
+        """
+        Run several searches in a single statement / round trip: the query vectors are
+        unnested with their fund / document filters (None = unfiltered) and each gets
+        its own LATERAL top-k scan.
+        Returns one result list per input embedding, in input order.
+        """
+        if not embeddings:
+            return []
+        fund_ids = fund_ids if fund_ids is not None else [None] * len(embeddings)
+        document_ids = document_ids if document_ids is not None else [None] * len(embeddings)
+        try:
+            params = {
+                "embeddings": [_vector_literal(e) for e in _normalize(np.vstack(embeddings))],
+                "fund_ids": list(fund_ids),
+                "document_ids": list(document_ids),
+                "k": k,
+            }
+            where_clause = (
+                "WHERE (q.fund_id IS NULL OR e.fund_id = q.fund_id)"
+                " AND (q.document_id IS NULL OR e.document_id = q.document_id)"
+            )
             sql = text(f"""
-                SELECT id, document_id, fund_id, content, metadata,
-                    1 - (embedding <=> CAST(:embedding AS vector)) AS similarity_score
-                FROM document_embeddings
-                {where_clause}
-                ORDER BY embedding <=> CAST(:embedding AS vector)
-                LIMIT :k
-            """)
-            result = self.db.execute(sql, params)
-            rows = result.fetchall()
-            out = []
+                SELECT q.ord, d.id, d.document_id, d.fund_id, d.content, d.metadata, d.similarity_score
+                    {", d.embedding" if include_embeddings else ""}
+                FROM unnest(
+                    CAST(CAST(:embeddings AS text[]) AS vector[]),
+                    CAST(:fund_ids AS integer[]),
+                    CAST(:document_ids AS integer[])
+                ) WITH ORDINALITY AS q(embedding, fund_id, document_id, ord)
+                CROSS JOIN LATERAL (
+                    SELECT e.id, e.document_id, e.fund_id, e.content, e.metadata, e.embedding,
+                        -(e.embedding <#> q.embedding) AS similarity_score
+                    FROM {self._knn_source(where_clause, "q.embedding", ":k")}
+                    ORDER BY e.embedding <#> q.embedding
+                    LIMIT :k
+                ) d
+                ORDER BY q.ord, d.similarity_score DESC
+            """).columns(metadata=JSONB)
+            async with AsyncSessionLocal() as db, db.begin():
+                await self._set_ef_search(db, k)
+                rows = (await db.execute(sql, params)).mappings().all()
+            out: List[List[Dict[str, Any]]] = [[] for _ in embeddings]
             for r in rows:
-                out.append({
-                    "id": r[0],
-                    "document_id": r[1],
-                    "fund_id": r[2],
-                    "content": r[3],
-                    "metadata": r[4],
-                    "score": float(r[5]) if r[5] is not None else None
-                })
+                out[r["ord"] - 1].append(_row_to_doc(r, include_embeddings))
             return out
         except Exception as e:
-            print(f"[VectorStore] similarity_search error: {e}")
+            print(f"[VectorStore] similarity_search_batch error: {e}")
+            return [[] for _ in embeddings]
+
+    async def similarity_search_many(
+        self,
+        queries: List[str],
+        k: int = 5,
+        filter_metadata: Optional[Dict[str, Any]] = None
+    ) -> List[List[Dict[str, Any]]]:
+        """
+        Multi-question search: one batched embedding call, then one batched SQL round trip.
+        filter_metadata (fund_id / document_id) applies to every question.
+        """
+        if not queries:
             return []
+        embs = await self._compute_embeddings(queries)
+        filters = filter_metadata or {}
+        return await self.similarity_search_batch(
+            list(embs),
+            k=k,
+            fund_ids=[filters.get("fund_id")] * len(queries),
+            document_ids=[filters.get("document_id")] * len(queries)
+        )
 
     def clear(self, fund_id: Optional[int] = None):
-        try:
-            if fund_id:
-                self.db.execute(text("DELETE FROM document_embeddings WHERE fund_id = :fund_id"), {"fund_id": fund_id})
-            else:
-                self.db.execute(text("DELETE FROM document_embeddings"))
-            self.db.commit()
-        except Exception as e:
-            print(f"[VectorStore] clear error: {e}")
-            self.db.rollback()
+        with SessionLocal() as db:
+            try:
+                if fund_id:
+                    db.execute(text("DELETE FROM document_embeddings WHERE fund_id = :fund_id"), {"fund_id": fund_id})
+                else:
+                    db.execute(text("DELETE FROM document_embeddings"))
+                db.commit()
+            except Exception as e:
+                print(f"[VectorStore] clear error: {e}")
+                db.rollback()
@@ -0,0 +1,41 @@
+"""
+TableParser: table categories and structured transaction extraction
+"""
+import pytest
+from app.services.document_processor import DocumentProcessor
+from app.services.table_parser import TableParser, classify_table
+
+
+@pytest.fixture
+def processor():
+    # _extract_table_transactions needs no DB, vector store or LLM clients
+    return DocumentProcessor.__new__(DocumentProcessor)
+
+
+@pytest.mark.parametrize("sheet, headers, expected", [
+    ("csv", ["Date", "Type", "Amount", "Recallable", "Description"], "distributions"),
+    ("csv", ["Date", "Return of Capital Amount", "Description"], "distributions"),
+    ("csv", ["Date", "Call Number", "Amount"], "capital_calls"),
+    ("Capital Calls", ["Date", "Amount"], "capital_calls"),
+    ("capital_calls", ["Date", "Amount"], "capital_calls"),
+    ("Distributions", ["Date", "Amount", "Recallable"], "distributions"),
+    ("csv", ["Date", "Adjustment Type", "Amount"], "adjustments"),
+    ("csv", ["Date", "Amount", "Description"], None),
+])
+def test_classify_table(sheet, headers, expected):
+    assert classify_table(sheet, headers) == expected
+
+
+def test_recallable_distributions_csv_is_not_booked_as_capital_calls(processor):
+    csv = (
+        b"Date,Type,Amount,Recallable,Description\n"
+        b"2023-06-30,Return of Capital,\"$1,500,000\",Yes,Exit proceeds\n"
+        b"2023-12-31,Income,500000,No,Dividend\n"
+    )
+    out = processor._extract_table_transactions(TableParser().parse(csv, "csv"))
+
+    assert out["capital_calls"] == []
+    assert [(d["distribution_date"], d["amount"], d["is_recallable"]) for d in out["distributions"]] == [
+        ("2023-06-30", 1500000.0, True),
+        ("2023-12-31", 500000.0, False),
+    ]
@@ -0,0 +1,51 @@
+"""
+VectorStore: filter handling of the batched search entry points
+"""
+import numpy as np
+import pytest
+from app.services.vector_store import VectorStore
+
+
+@pytest.fixture
+def store(monkeypatch):
+    # no DB or embedding model: capture what would be sent to similarity_search_batch
+    store = VectorStore.__new__(VectorStore)
+    store.calls = []
+
+    async def compute_embeddings(texts):
+        return np.ones((len(texts), 4), dtype=np.float32)
+
+    async def search_batch(embeddings, k=5, fund_ids=None, include_embeddings=False, document_ids=None):
+        store.calls.append({"n": len(embeddings), "k": k, "fund_ids": fund_ids, "document_ids": document_ids})
+        return [[] for _ in embeddings]
+
+    monkeypatch.setattr(store, "_compute_embeddings", compute_embeddings)
+    monkeypatch.setattr(store, "similarity_search_batch", search_batch)
+    return store
+
+
+@pytest.mark.asyncio
+async def test_similarity_search_many_applies_document_filter(store):
+    results = await store.similarity_search_many(
+        ["What is the DPI?", "When was the last call?"], k=3, filter_metadata={"fund_id": 1, "document_id": 7}
+    )
+
+    assert results == [[], []]
+    assert store.calls == [{"n": 2, "k": 3, "fund_ids": [1, 1], "document_ids": [7, 7]}]
+
+
+@pytest.mark.asyncio
+async def test_similarity_search_many_without_filters(store):
+    await store.similarity_search_many(["q"])
+
+    assert store.calls[0]["fund_ids"] == [None]
+    assert store.calls[0]["document_ids"] == [None]
+
+
+@pytest.mark.asyncio
+async def test_similarity_search_is_a_single_query_batch(store):
+    await store.similarity_search(
+        "q", k=4, filter_metadata={"document_id": 7}, embedding=np.ones(4, dtype=np.float32)
+    )
+
+    assert store.calls == [{"n": 1, "k": 4, "fund_ids": [None], "document_ids": [7]}]